@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import importlib
+import json
+import logging
+import socket
+import threading
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kBackends = ["google", "local", "replay", "http"]
+kResultsPerPage = 10
+kGoogleHost = "www.google.com"
+# keep-alive connections pooled per http backend
+kHttpConnections = 32
+# seconds to connect to an http backend, and to wait for its response
+kHttpTimeout = (1.0, 10.0)
+
+SearchResult = collections.namedtuple(
+    "SearchResult", ["name", "link", "description", "number_of_results"])
+
+
+def pack_results(results):
+    """Packs search results into compact lists for caching and recording
+    """
+    return [[r.name, r.link, r.description,
+             getattr(r, "number_of_results", None)] for r in results]
+
+
+def unpack_results(packed):
+    """Rebuilds search results from pack_results output
+    """
+    return [SearchResult(*r) for r in packed]
+
+
+def normalize_query(query):
+    """Normalizes a query for use as a cache or recording key
+    """
+    return " ".join(query.lower().split())
+
+
+class GoogleBackend:
+    """Searches by scraping google result pages
+    """
+    name = "google"
+
+    def search(self, query, pages=1, first_page=0):
+        """Returns the results of a query
+
+        Args:
+            query (String): to search for
+            pages (Number): of result pages to fetch
+            first_page (Number): index of the first page to fetch
+        Returns:
+            (List): of results, each with a name, link and description
+        """
+        # imported here, the scraper pulls in selenium and bs4
+        from google import google
+        return google.search(query, pages, first_page=first_page)
+
+    def warm_up(self):
+        """Loads the scraper and resolves google ahead of the first search
+        """
+        importlib.import_module("google.google")
+        socket.getaddrinfo(kGoogleHost, 443)
+
+    def close(self):
+        pass
+
+
+class LocalBackend:
+    """Searches a local corpus through an inverted index built with index.py
+    """
+    name = "local"
+
+    def __init__(self, index_dir):
+        import index
+        self.index = index.Index(index_dir)
+
+    def search(self, query, pages=1, first_page=0):
+        """Returns the results of a query, ranked with BM25
+
+        Args:
+            query (String): to search for
+            pages (Number): of kResultsPerPage results to return
+            first_page (Number): index of the first page to return
+        Returns:
+            (List): of results, each with a name, link and description
+        """
+        hits, matches = self.index.search(query, pages * kResultsPerPage,
+                                          first_page * kResultsPerPage)
+        results = []
+        for doc_id, _ in hits:
+            title, text = self.index.document(doc_id)
+            results.append(SearchResult(
+                title, "local:{}".format(doc_id), text, matches))
+        return results
+
+    def warm_up(self):
+        """Runs a search, so the index pages of common terms are mapped in
+        """
+        self.search("the")
+
+    def close(self):
+        self.index.close()
+
+
+class RecordingBackend:
+    """Wraps a backend, appending every query and its results to a JSON lines
+    file that ReplayBackend can serve later
+    """
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.name = backend.name
+        self.path = path
+        self.lock = threading.Lock()
+
+    def search(self, query, pages=1, first_page=0):
+        results = self.backend.search(query, pages, first_page)
+        line = json.dumps({"query": normalize_query(query), "pages": pages,
+                           "first_page": first_page,
+                           "results": pack_results(results)})
+        with self.lock:
+            with open(self.path, "a") as fp:
+                fp.write(line + "\n")
+        return results
+
+    def warm_up(self):
+        self.backend.warm_up()
+
+    def close(self):
+        self.backend.close()
+
+
+class CoalescingBackend:
+    """Wraps a backend shared by several sessions. A search made while an
+    identical one is already in flight waits for that one's results rather
+    than going out to the backend again.
+    """
+
+    def __init__(self, backend):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.backend = backend
+        self.name = backend.name
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.coalesced = 0
+
+    def search(self, query, pages=1, first_page=0):
+        key = (normalize_query(query), pages, first_page)
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            # copied, so no session sees another's changes to the list
+            return list(future.result())
+        try:
+            results = self.backend.search(query, pages, first_page)
+            future.set_result(results)
+            return results
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def warm_up(self):
+        self.backend.warm_up()
+
+    def close(self):
+        self.logger.info("Coalesced {} searches".format(self.coalesced))
+        self.backend.close()
+
+
+class ReplayBackend:
+    """Serves results recorded by RecordingBackend, so searches are offline
+    and deterministic. A multi page query that wasn't recorded as one is
+    assembled from its single page recordings, as fan-out searches make them.
+    Queries that were never recorded return no results.
+    """
+    name = "replay"
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.recordings = {}
+        self.misses = 0
+        with open(path) as fp:
+            for line in fp:
+                record = json.loads(line)
+                key = (record["query"], record["pages"], record["first_page"])
+                self.recordings[key] = record["results"]
+        self.logger.info("Loaded {} recorded searches from {}".format(
+            len(self.recordings), path))
+
+    def search(self, query, pages=1, first_page=0):
+        query = normalize_query(query)
+        packed = self.recordings.get((query, pages, first_page))
+        if packed is None:
+            pages_packed = [self.recordings.get((query, 1, page))
+                            for page in range(first_page, first_page + pages)]
+            if any(p is None for p in pages_packed):
+                self.misses += 1
+                self.logger.info("No recording for \"{}\"".format(query))
+                return []
+            packed = [r for p in pages_packed for r in p]
+        return unpack_results(packed)
+
+    def warm_up(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class HttpBackend:
+    """Searches a server speaking the standin.py API, e.g. the stand-in
+    itself serving recorded searches, over pooled keep-alive connections:
+        GET <url>/search?q=<query>&pages=<n>&first_page=<n>
+    responds with {"results": [...]} as packed by pack_results.
+    """
+    name = "http"
+
+    def __init__(self, url, connections=kHttpConnections):
+        # imported here, requests is only needed to search over http
+        import requests
+        from requests import adapters
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        adapter = adapters.HTTPAdapter(pool_connections=1,
+                                       pool_maxsize=connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def search(self, query, pages=1, first_page=0):
+        response = self.session.get(
+            self.url + "/search", timeout=kHttpTimeout,
+            params={"q": query, "pages": pages, "first_page": first_page})
+        response.raise_for_status()
+        return unpack_results(response.json()["results"])
+
+    def warm_up(self):
+        """Opens a connection to the server ahead of the first search
+        """
+        self.session.get(self.url + "/health",
+                         timeout=kHttpTimeout).raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+def make_backend(spec, record=None):
+    """Creates a search backend from a spec string
+
+    Args:
+        spec (String): one of google, local:<index directory>,
+                       replay:<recording file> or http://<host>:<port>
+        record (String): file to record every search to, None to not record
+    Returns:
+        A backend exposing search(query, pages, first_page), warm_up() and
+        close()
+    """
+    name, _, arg = spec.partition(":")
+    if name not in kBackends:
+        raise ValueError("Unknown search backend {}, expected one of {}".format(
+            name, kBackends))
+    if name != "google" and not arg:
+        raise ValueError("{} search backend needs a path".format(name))
+    if name == "local":
+        backend = LocalBackend(arg)
+    elif name == "replay":
+        backend = ReplayBackend(arg)
+    elif name == "http":
+        backend = HttpBackend(spec)
+    else:
+        backend = GoogleBackend()
+    if record:
+        backend = RecordingBackend(backend, record)
+    return backend
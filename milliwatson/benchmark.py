@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import backends
+import metrics
+import normalize
+import ocr
+import query
+import store
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kCapturePattern = re.compile(r"capture_(.+)\.png$")
+# relative slowdown of a stage over the baseline that counts as a regression
+kDefaultTolerance = 0.2
+# and the ms it must also slow down by, so timer noise on stages that take
+# next to no time isn't reported
+kDefaultMinDelta = 2.0
+
+
+def find_captures(images_dir, result_store):
+    """Pairs every saved capture with the results saved for it, if any
+
+    Returns:
+        (List): of (id, image path, results dict or None), sorted by id
+    """
+    captures = []
+    for image_path in glob.glob(os.path.join(images_dir, "capture_*.png")):
+        match = kCapturePattern.search(os.path.basename(image_path))
+        capture_id = match.group(1)
+        captures.append((capture_id, image_path, result_store.get(capture_id)))
+    return sorted(captures, key=lambda c: c[0])
+
+
+class Benchmark:
+    """Replays saved captures through the OCR -> query -> scoring pipeline,
+    serving searches from recorded responses so every run is deterministic
+    """
+
+    def __init__(self, config_file, recordings, engine_name="auto",
+                 fanout=False, tight_crop=True, number_words=False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.metrics = metrics.Metrics()
+        self.ocr = ocr.OCR(config_file, engine_name, metrics=self.metrics,
+                           tight_crop=tight_crop)
+        self.backend = backends.ReplayBackend(recordings)
+        self.wb = query.WebQuery(self.backend, None, self.metrics,
+                                 number_words=number_words)
+        self.wb.open_browser = False
+        self.fanout = fanout
+
+    def run_one(self, image_path):
+        """Runs the pipeline on one capture
+
+        Returns:
+            (Dict): of the OCR'd question, answers and ranked results
+        """
+        with self.metrics.stage("load"):
+            self.ocr.load_image(image_path)
+        question, *answers = self.ocr.ocr_regions()
+        with self.metrics.stage("normalize"):
+            question = normalize.normalize(question)
+            answers = [normalize.normalize(a) for a in answers]
+        with self.metrics.stage("query"):
+            if self.fanout:
+                self.wb.search_fanout(question, answers)
+            else:
+                self.wb.search_google(question)
+            counts = self.wb.answer_frequency_fuzzy(answers)
+        return {"question": question, "answers": answers, "results": counts}
+
+    def run(self, captures, labels=None):
+        """Runs every capture and builds a report of latency, throughput and
+        accuracy against the labels
+
+        Args:
+            captures (List): from find_captures
+            labels (Dict): of capture id to the correct answer
+        Returns:
+            (Dict): the report
+        """
+        labels = labels or {}
+        correct = 0
+        labelled = 0
+        ocr_agree = 0
+        recorded = 0
+        # keep the one-off start up costs out of the first capture's timings
+        self.ocr.warm_up()
+        self.wb.warm_up()
+        start = time.perf_counter()
+        for capture_id, image_path, saved in captures:
+            with self.metrics.stage("total"):
+                outcome = self.run_one(image_path)
+            if saved is not None:
+                recorded += 1
+                if saved.get("question") == outcome["question"] and \
+                        saved.get("answers") == outcome["answers"]:
+                    ocr_agree += 1
+            if capture_id in labels:
+                labelled += 1
+                if outcome["results"] and \
+                        outcome["results"][0][0] == \
+                        normalize.normalize(labels[capture_id]):
+                    correct += 1
+        elapsed = time.perf_counter() - start
+
+        stages = {}
+        for name, histogram in self.metrics.histograms.items():
+            stages[name] = {
+                "count": histogram.count,
+                "mean_ms": 1000.0 * histogram.total / histogram.count,
+                "p50_ms": 1000.0 * histogram.percentile(0.5),
+                "p95_ms": 1000.0 * histogram.percentile(0.95),
+                "p99_ms": 1000.0 * histogram.percentile(0.99),
+                "per_second": histogram.count / histogram.total
+                if histogram.total else 0.0,
+            }
+        return {
+            "captures": len(captures),
+            "captures_per_second": len(captures) / elapsed if elapsed else 0.0,
+            "stages": stages,
+            "accuracy": correct / labelled if labelled else None,
+            "labelled": labelled,
+            "ocr_agreement": ocr_agree / recorded if recorded else None,
+            "search_misses": self.backend.misses,
+        }
+
+    def close(self):
+        self.ocr.close()
+
+
+def compare(report, baseline, tolerance=kDefaultTolerance,
+            min_delta=kDefaultMinDelta):
+    """Compares a report against a baseline report. A stage regressed if it
+    got slower by both more than tolerance and more than min_delta ms.
+
+    Returns:
+        (List): of strings describing each regression, empty if none
+    """
+    regressions = []
+    for name, stage in baseline["stages"].items():
+        current = report["stages"].get(name)
+        if current is None:
+            continue
+        for key in ["p50_ms", "p95_ms"]:
+            if current[key] > stage[key] * (1 + tolerance) and \
+                    current[key] - stage[key] > min_delta:
+                regressions.append("{} {} {:.1f} -> {:.1f}".format(
+                    name, key, stage[key], current[key]))
+    for key in ["accuracy", "ocr_agreement"]:
+        if baseline.get(key) is not None and report.get(key) is not None \
+                and report[key] < baseline[key]:
+            regressions.append("{} {:.3f} -> {:.3f}".format(
+                key, baseline[key], report[key]))
+    return regressions
+
+
+def print_report(report):
+    print("{:<24}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+        "stage", "count", "p50 ms", "p95 ms", "p99 ms", "per sec"))
+    for name, stage in report["stages"].items():
+        print("{:<24}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            name, stage["count"], stage["p50_ms"], stage["p95_ms"],
+            stage["p99_ms"], stage["per_second"]))
+    print("Captures: {} ({:.2f}/s), search misses: {}".format(
+        report["captures"], report["captures_per_second"],
+        report["search_misses"]))
+    if report["accuracy"] is not None:
+        print("Accuracy: {:.1%} of {} labelled".format(
+            report["accuracy"], report["labelled"]))
+    if report["ocr_agreement"] is not None:
+        print("OCR agreement with saved results: {:.1%}".format(
+            report["ocr_agreement"]))
+
+
+def main():
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description="Replays saved captures through the pipeline and reports\
+         latency, throughput and accuracy")
+    arg_parser.add_argument("--config_file", "-f",
+                            help="The phone config file (default: iphone_x_macpro_2880x1800)",
+                            default="configs/iphone_x_macpro_2880x1800")
+    arg_parser.add_argument("--images", default="images",
+                            help="Directory of saved captures (default: images)")
+    arg_parser.add_argument("--results", default="results/results.db",
+                            help="Result store of the saved captures "
+                            "(default: results/results.db)")
+    arg_parser.add_argument("--recordings", required=True,
+                            help="Search recordings made with --record_searches")
+    arg_parser.add_argument("--labels",
+                            help="JSON file mapping capture id to the correct answer")
+    arg_parser.add_argument("--engine", "-e", default="auto",
+                            help="The OCR engine (default: auto)")
+    arg_parser.add_argument("--fanout", action='store_true',
+                            help="Replay fan-out searches")
+    arg_parser.add_argument("--no_tight_crop", action='store_true',
+                            help="OCR the configured sections as they are")
+    arg_parser.add_argument("--number_words", action='store_true',
+                            help="Spell out numbers when scoring")
+    arg_parser.add_argument("--report", help="Write the report as JSON here")
+    arg_parser.add_argument("--baseline",
+                            help="Baseline report to check for regressions")
+    arg_parser.add_argument("--tolerance", type=float, default=kDefaultTolerance,
+                            help="Allowed relative slowdown per stage (default: 0.2)")
+    arg_parser.add_argument("--min_delta", type=float, default=kDefaultMinDelta,
+                            help="Allowed slowdown per stage in ms, whatever "
+                            "the relative slowdown (default: 2)")
+    args = arg_parser.parse_args()
+
+    result_store = store.ResultStore(args.results)
+    captures = find_captures(args.images, result_store)
+    result_store.close()
+    labels = None
+    if args.labels:
+        with open(args.labels) as fp:
+            labels = json.load(fp)
+
+    bench = Benchmark(args.config_file, args.recordings, args.engine,
+                      args.fanout, not args.no_tight_crop, args.number_words)
+    try:
+        report = bench.run(captures, labels)
+    finally:
+        bench.close()
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as fp:
+            json.dump(report, fp, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(report, baseline, args.tolerance,
+                              args.min_delta)
+        for regression in regressions:
+            print("REGRESSION: {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+# how many disk writes between checks of the disk tier size
+kEvictInterval = 64
+
+
+class LRUCache:
+    """Thread safe in-memory cache, evicting the least recently used entry
+    once max_size entries are stored
+    """
+
+    def __init__(self, max_size=256, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, created = entry
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, created=None):
+        with self.lock:
+            self.entries[key] = (value, created or time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskCache:
+    """SQLite backed cache of JSON serializable values. Entries expire after
+    ttl seconds, and the least recently used entries are dropped once more
+    than max_entries are stored.
+    """
+
+    def __init__(self, path, max_entries=100000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache ("
+                        "key TEXT PRIMARY KEY, value TEXT, "
+                        "created REAL, accessed REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_accessed "
+                        "ON cache (accessed)")
+        self.db.commit()
+
+    def get(self, key):
+        """Returns (value, created) for the key, or None if missing or expired
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, created FROM cache WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE cache SET accessed = ? WHERE key = ?",
+                            (now, key))
+            self.db.commit()
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                            (key, json.dumps(value, separators=(",", ":")),
+                             now, now))
+            self.puts += 1
+            if self.puts % kEvictInterval == 0:
+                self.evict()
+            self.db.commit()
+
+    def evict(self):
+        """Drops expired entries, then the least recently used ones beyond
+        max_entries. Expects the lock to be held.
+        """
+        if self.ttl is not None:
+            self.db.execute("DELETE FROM cache WHERE created < ?",
+                            (time.time() - self.ttl,))
+        self.db.execute("DELETE FROM cache WHERE key IN ("
+                        "SELECT key FROM cache ORDER BY accessed DESC "
+                        "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class TieredCache:
+    """Two tier cache, an in-memory LRU in front of an optional on-disk store.
+    Values must be JSON serializable to be persisted.
+    """
+
+    def __init__(self, path=None, memory_size=256, max_disk_entries=100000,
+                 ttl=None):
+        """
+        Args:
+            path (String): of the on-disk store, None to keep memory only
+            memory_size (Number): of entries kept in memory
+            max_disk_entries (Number): of entries kept on disk
+            ttl (Number): seconds before an entry expires, None to never expire
+        """
+        self.memory = LRUCache(memory_size, ttl)
+        self.disk = None
+        if path:
+            self.disk = DiskCache(path, max_disk_entries, ttl)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached value, or None on a miss
+        """
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                value, created = entry
+                self.memory.put(key, value, created)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def stats(self):
+        """Returns a summary string of the cache hit rate
+        """
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return "{} hits ({} from disk), {} misses, {:.1f}% hit rate".format(
+            self.hits, self.disk_hits, self.misses, rate)
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import logging
+
+import numpy as np
+from PIL import Image
+from PIL import ImageStat
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+
+
+def dhash(image, size=8):
+    """Computes a difference hash of an image. Visually similar images
+    produce hashes with a small hamming distance.
+
+    Args:
+        image: PIL.Image to hash
+        size (Number): of the hash grid, the hash is size * size bits
+    Returns:
+        (Number): the hash packed into an int
+    """
+    small = image.convert("L").resize((size + 1, size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming(a, b):
+    """Returns the number of differing bits between two hashes
+    """
+    return bin(a ^ b).count("1")
+
+
+def sharpness(image):
+    """Measures how sharp an image is as the variance of its Laplacian.
+    Frames caught mid-transition or with motion blur score lower.
+
+    Args:
+        image: PIL.Image to measure
+    Returns:
+        (Number): the variance, higher is sharper
+    """
+    gray = np.asarray(image.convert("L"), dtype=np.float32)
+    if gray.shape[0] < 3 or gray.shape[1] < 3:
+        return 0.0
+    laplacian = gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + \
+        gray[1:-1, 2:] - 4 * gray[1:-1, 1:-1]
+    return float(laplacian.var())
+
+
+class QuestionGate:
+    """Decides which frames of the question section are worth running OCR on.
+    A frame passes only once the section holds a card that has stayed the same
+    for stable_frames frames in a row, once per card. Blank sections and
+    frames mid-transition never pass. The hash is too coarse to tell similar
+    question cards apart, so a card that comes back after a blank or a
+    transition passes again; repeated questions are caught by their OCR text.
+    When frames are passed along with their sections, the sharpest frame of
+    the stable run is kept as the keyframe to run OCR on.
+    """
+
+    def __init__(self, stable_frames=2, threshold=6, blank_stddev=8):
+        """
+        Args:
+            stable_frames (Number): of matching frames before a card is stable
+            threshold (Number): max hash distance for two frames to match
+            blank_stddev (Number): pixel stddev below which a section is blank
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.stable_frames = stable_frames
+        self.threshold = threshold
+        self.blank_stddev = blank_stddev
+        self.candidate = None
+        self.count = 0
+        self.keyframe = None
+        self.keyframe_sharpness = 0.0
+
+    def update(self, section, frame=None):
+        """Feeds the question section of the latest frame through the gate
+
+        Args:
+            section: PIL.Image of the question section
+            frame: the full frame the section came from, a keyframe candidate
+        Returns:
+            (Bool): True if the section just became a stable question card
+        """
+        if ImageStat.Stat(section.convert("L")).stddev[0] < self.blank_stddev:
+            self.candidate = None
+            self.count = 0
+            self.keyframe = None
+            return False
+        frame_hash = dhash(section)
+        if self.candidate is not None and \
+                hamming(frame_hash, self.candidate) <= self.threshold:
+            self.count += 1
+        else:
+            self.candidate = frame_hash
+            self.count = 1
+            self.keyframe = None
+        if frame is not None:
+            section_sharpness = sharpness(section)
+            if self.keyframe is None or \
+                    section_sharpness > self.keyframe_sharpness:
+                self.keyframe = frame
+                self.keyframe_sharpness = section_sharpness
+        # only fire on the frame the card becomes stable, not every frame after
+        return self.count == self.stable_frames
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import logging
+
+import cv2
+import numpy as np
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+# joins the letters of a word, and words of a line, into one blob
+kJoinKernel = np.ones((5, 15), np.uint8)
+# blobs smaller than this, in pixels, are specks rather than text
+kMinTextArea = 120
+# white border kept around cropped text, tesseract reads poorly at the edge
+kTextPadding = 10
+# an answer box spans at least this fraction of the frame width
+kMinBoxWidth = 0.6
+# and its height is within this range of fractions of its width
+kBoxAspect = (0.08, 0.35)
+# pixels trimmed inside the top and bottom of a detected box, clear of its
+# outline. The sides are trimmed by half the height, clear of round corners.
+kBoxInset = 8
+
+
+def text_box(section, min_area=kMinTextArea):
+    """Finds the box around all the text of a binarized section
+
+    Args:
+        section: uint8 NumPy array, 0 for text 255 otherwise
+        min_area (Number): of a blob of text, smaller blobs are ignored
+    Returns:
+        (Tuple): of (x0, y0, x1, y1), or None if the section has no text
+    """
+    ink = cv2.bitwise_not(section)
+    blobs = cv2.dilate(ink, kJoinKernel)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(blobs)
+    # label 0 is the background
+    stats = stats[1:count]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= min_area]
+    if not len(stats):
+        return None
+    x0 = stats[:, cv2.CC_STAT_LEFT].min()
+    y0 = stats[:, cv2.CC_STAT_TOP].min()
+    x1 = (stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH]).max()
+    y1 = (stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT]).max()
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+def tight_crop(section, padding=kTextPadding):
+    """Crops a binarized section down to its text, so tesseract doesn't
+    spend time laying out blank space
+
+    Returns:
+        uint8 NumPy array of the text with a white border, or None if the
+        section has no text
+    """
+    box = text_box(section)
+    if box is None:
+        return None
+    x0, y0, x1, y1 = box
+    return cv2.copyMakeBorder(section[y0:y1, x0:x1], padding, padding,
+                              padding, padding, cv2.BORDER_CONSTANT,
+                              value=255)
+
+
+def find_answer_boxes(image, top, num_answers):
+    """Finds the outlined answer boxes of a frame
+
+    Args:
+        image: PIL.Image of the full frame
+        top (Number): y below which to look, the bottom of the question
+        num_answers (Number): of boxes expected
+    Returns:
+        (List): of (x, y, w, h) inside each box from the top of the screen,
+                or None if exactly num_answers boxes weren't found
+    """
+    gray = np.asarray(image.convert("L"))
+    edges = cv2.Canny(gray[top:], 50, 150)
+    # close small gaps in the outlines, e.g. from anti-aliased corners
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    # OpenCV 3 returns the image as well as the contours
+    contours = cv2.findContours(edges, cv2.RETR_EXTERNAL,
+                                cv2.CHAIN_APPROX_SIMPLE)[-2]
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w < kMinBoxWidth * gray.shape[1]:
+            continue
+        if not kBoxAspect[0] * w <= h <= kBoxAspect[1] * w:
+            continue
+        boxes.append((x + h // 2, top + y + kBoxInset,
+                      w - 2 * (h // 2), h - 2 * kBoxInset))
+    if len(boxes) != num_answers:
+        return None
+    return sorted(boxes, key=lambda b: b[1])
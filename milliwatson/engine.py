@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import logging
+import queue
+
+from PIL import Image
+from PIL import ImageDraw
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kEngines = ["auto", "tesserocr", "pytesseract"]
+# tesseract page segmentation modes
+kPSMAuto = 3
+kPSMBlock = 6
+kPSMLine = 7
+
+
+def warm_up_image():
+    """Returns a small image of a single word, for warming up an engine
+    """
+    image = Image.new("L", (96, 32), 255)
+    ImageDraw.Draw(image).text((8, 10), "Warm", fill=0)
+    return image
+
+
+def to_pil(image):
+    """Returns a PIL.Image for either a PIL.Image or a NumPy buffer
+    """
+    if isinstance(image, Image.Image):
+        return image
+    return Image.fromarray(image)
+
+
+class PytesseractEngine:
+    """OCR engine that shells out to the tesseract binary on every call.
+    Each call writes a temp image and reloads the language model, so this is
+    only kept as a fallback for when tesserocr is unavailable.
+    """
+    name = "pytesseract"
+
+    def __init__(self, workers=1, lang="eng"):
+        self.lang = lang
+
+    def recognize(self, image, psm=None, chars=None):
+        """Returns the string detected in an image
+
+        Args:
+            image: PIL.Image or NumPy buffer
+            psm (Number): page segmentation mode, default: tesseract's own
+            chars (String): to restrict recognition to, default: any
+        """
+        # imported here, as tesserocr is used whenever it's installed
+        import pytesseract
+        config = []
+        if psm is not None:
+            config.append("--psm {}".format(psm))
+        if chars:
+            config.append("-c tessedit_char_whitelist={}".format(chars))
+        return pytesseract.image_to_string(to_pil(image), lang=self.lang,
+                                           config=" ".join(config))
+
+    def warm_up(self):
+        """Runs tesseract once, so its binary and model are in the page cache
+        """
+        self.recognize(warm_up_image(), kPSMLine)
+
+    def close(self):
+        pass
+
+
+class TesserocrEngine:
+    """OCR engine backed by resident tesseract API handles.
+    The language model is loaded once per handle when the engine is created.
+    A single handle is not thread safe, so one is pooled per worker and
+    images are handed to it in memory.
+    """
+    name = "tesserocr"
+
+    def __init__(self, workers=1, lang="eng"):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.info("Starting {} tesseract API handle(s)".format(workers))
+        self.workers = workers
+        self.apis = queue.Queue()
+        for _ in range(workers):
+            self.apis.put(tesserocr.PyTessBaseAPI(lang=lang))
+
+    def recognize(self, image, psm=None, chars=None):
+        """Returns the string detected in an image
+
+        Args:
+            image: PIL.Image or NumPy buffer
+            psm (Number): page segmentation mode, default: tesseract's own
+            chars (String): to restrict recognition to, default: any
+        """
+        api = self.apis.get()
+        try:
+            # handles are shared by every region, so set both each time
+            api.SetPageSegMode(kPSMAuto if psm is None else psm)
+            api.SetVariable("tessedit_char_whitelist", chars or "")
+            api.SetImage(to_pil(image))
+            return api.GetUTF8Text()
+        finally:
+            api.Clear()
+            self.apis.put(api)
+
+    def warm_up(self):
+        """Recognizes an image on every handle, so tesseract's lazily
+        initialized state is set up before the first question
+        """
+        apis = [self.apis.get() for _ in range(self.workers)]
+        try:
+            for api in apis:
+                api.SetPageSegMode(kPSMLine)
+                api.SetImage(warm_up_image())
+                api.GetUTF8Text()
+                api.Clear()
+        finally:
+            for api in apis:
+                self.apis.put(api)
+
+    def close(self):
+        while not self.apis.empty():
+            self.apis.get().End()
+
+
+def make_engine(name="auto", workers=1, lang="eng"):
+    """Creates an OCR engine by name
+
+    Args:
+        name (String): one of kEngines, auto prefers tesserocr when installed
+        workers (Number): of images the engine should be able to process at once
+    Returns:
+        An engine exposing recognize(image, psm, chars), warm_up() and close()
+    """
+    if name not in kEngines:
+        raise ValueError("Unknown OCR engine {}, expected one of {}".format(
+            name, kEngines))
+    if name == "auto":
+        name = "tesserocr" if tesserocr is not None else "pytesseract"
+    if name == "tesserocr":
+        if tesserocr is None:
+            raise ValueError("tesserocr engine requested but not installed")
+        return TesserocrEngine(workers, lang)
+    return PytesseractEngine(workers, lang)
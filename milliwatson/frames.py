@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import glob
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+from PIL import Image
+
+try:
+    import mss
+except ImportError:
+    mss = None
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kFrameSources = ["screencapture", "replay", "x11", "video"]
+kDefaultReplayPattern = "images/capture_*.png"
+# video frames skipped for every one decoded
+kDefaultVideoSkip = 2
+
+
+class ScreenCaptureSource:
+    """Grabs the QuickTime Player window on macOS using screencapture.
+    screencapture can only write to a file, so frames are written as
+    uncompressed BMP to a private temp directory to keep the encode and
+    decode down to a memory copy.
+    """
+    # grab returns the screen as it is now, so callers pace their own grabs
+    paced = False
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.window_id = None
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="milliwatson")
+        self.tmp_file = os.path.join(self.tmp_dir.name, "frame.bmp")
+
+    def grab(self):
+        """Returns the current frame as a PIL.Image
+        """
+        if self.window_id is None:
+            self.warm_up()
+        # the window shadow is kept, the configs' padding is measured with it
+        subprocess.check_call(["screencapture", "-x", "-t", "bmp",
+                               "-l{}".format(self.window_id), self.tmp_file])
+        with Image.open(self.tmp_file) as image:
+            image.load()
+            return image.convert("RGB")
+
+    def warm_up(self):
+        # use Applescript to find the windowid param to pass to
+        # screencapture, it doesn't change while QuickTime stays open
+        self.window_id = subprocess.check_output(
+            ["osascript", "-e",
+             "tell app \"QuickTime Player\" to id of window 1"]
+        ).decode().strip()
+
+    def close(self):
+        self.tmp_dir.cleanup()
+
+
+class ReplaySource:
+    """Replays previously saved captures from disk, one per grab. Captures
+    saved downscaled are scaled back up to the capture size.
+    """
+    paced = False
+
+    def __init__(self, pattern=kDefaultReplayPattern, loop=False, size=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.size = size
+        self.files = sorted(glob.glob(pattern))
+        self.loop = loop
+        self.index = 0
+        self.logger.info("Replaying {} frames from {}".format(
+            len(self.files), pattern))
+
+    def grab(self):
+        """Returns the next saved frame as a PIL.Image, or None when exhausted
+        """
+        if self.index >= len(self.files):
+            if not self.loop or not self.files:
+                return None
+            self.index = 0
+        file_name = self.files[self.index]
+        self.index += 1
+        with Image.open(file_name) as image:
+            image.load()
+            image = image.convert("RGB")
+        if self.size is not None and image.size != self.size:
+            image = image.resize(self.size, Image.BILINEAR)
+        return image
+
+    def warm_up(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class X11Source:
+    """Grabs a region of an X11 display through mss, which reads the frame
+    buffer over shared memory when the server supports it
+    """
+    paced = False
+
+    def __init__(self, x, y, w, h):
+        if mss is None:
+            raise ValueError("x11 frame source requested but mss not installed")
+        self.monitor = {"left": x, "top": y, "width": w, "height": h}
+        # mss handles can't be shared between threads
+        self.local = threading.local()
+
+    def grab(self):
+        """Returns the current frame as a PIL.Image
+        """
+        if not hasattr(self.local, "sct"):
+            self.local.sct = mss.mss()
+        shot = self.local.sct.grab(self.monitor)
+        return Image.frombuffer("RGB", shot.size, shot.bgra, "raw", "BGRX")
+
+    def warm_up(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class VideoSource:
+    """Decodes frames from a video file or capture device with OpenCV.
+    Skipped frames are grabbed but never retrieved, so they skip the color
+    conversion and copy out, and a recorded game can be fed through the
+    pipeline far faster than real time. Frames are scaled to
+    the capture size of the config if the video differs.
+    """
+    # grab waits for the next frame of the video itself
+    paced = True
+
+    def __init__(self, source, width, height, skip=kDefaultVideoSkip):
+        """
+        Args:
+            source (String): path of a video file, or index of a device
+            width (Number): of the frames to return
+            height (Number): of the frames to return
+            skip (Number): of frames to drop after every decoded frame
+        """
+        try:
+            import cv2
+        except ImportError:
+            raise ValueError("video frame source requested but opencv not "
+                             "installed")
+        self.logger = logging.getLogger(self.__class__.__name__)
+        device = int(source) if source.isdigit() else source
+        self.capture = cv2.VideoCapture(device)
+        if not self.capture.isOpened():
+            raise ValueError("Unable to open video {}".format(source))
+        self.size = (width, height)
+        self.skip = skip
+        self.logger.info("Decoding video from {}, keeping 1 in {} frames".format(
+            source, skip + 1))
+
+    def grab(self):
+        """Returns the next kept frame as a PIL.Image, or None when the video
+        has ended
+        """
+        import cv2
+        for _ in range(self.skip):
+            if not self.capture.grab():
+                return None
+        ok, frame = self.capture.read()
+        if not ok:
+            return None
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return Image.fromarray(frame)
+
+    def warm_up(self):
+        pass
+
+    def close(self):
+        self.capture.release()
+
+
+def default_frame_source():
+    """Returns the frame source spec suited to the current platform
+    """
+    return "screencapture" if sys.platform == "darwin" else "x11"
+
+
+def make_frame_source(spec, width, height):
+    """Creates a frame source from a spec string
+
+    Args:
+        spec (String): one of
+            screencapture
+            replay[:<glob>]          (default: images/capture_*.png)
+            x11[:<x>,<y>,<w>,<h>]    (default: 0,0,width,height)
+            video:<file or device>[@<skip>]
+        width (Number): of the capture, the default x11 region and the size
+                        video and replayed frames are scaled to
+        height (Number): of the capture, as width
+    Returns:
+        A frame source exposing grab(), warm_up() and close()
+    """
+    name, _, arg = spec.partition(":")
+    if name not in kFrameSources:
+        raise ValueError("Unknown frame source {}, expected one of {}".format(
+            name, kFrameSources))
+    if name == "screencapture":
+        return ScreenCaptureSource()
+    if name == "replay":
+        return ReplaySource(arg or kDefaultReplayPattern,
+                            size=(width, height))
+    if name == "video":
+        source, _, skip = arg.rpartition("@")
+        if not source or not skip.isdigit():
+            source, skip = arg, kDefaultVideoSkip
+        if not source:
+            raise ValueError("video frame source needs a file or device")
+        return VideoSource(source, width, height, int(skip))
+    region = [0, 0, width, height]
+    if arg:
+        region = [int(v) for v in arg.split(",")]
+    return X11Source(*region)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+import array
+import collections
+import heapq
+import itertools
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+
+import numpy as np
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kTokenPattern = re.compile(r"\w+")
+kStopWords = frozenset(["a", "an", "and", "are", "as", "at", "be", "by", "for",
+                        "from", "in", "is", "it", "of", "on", "or", "that",
+                        "the", "this", "to", "was", "what", "which", "who",
+                        "with"])
+# BM25 tuning parameters
+kK1 = 1.2
+kB = 0.75
+# documents handed to a tokenizer worker at once
+kBatchSize = 2000
+# batches queued per worker, bounds how much of the corpus is in memory
+kBatchesPerWorker = 4
+# postings held in memory before they are spilled to a run file
+kSpillPostings = 20000000
+# length prefix of a term in a run file, followed by its number of postings
+kRunHeader = struct.Struct("<HI")
+
+
+def tokenize(text):
+    """Returns the lowercase word tokens of a string
+    """
+    return kTokenPattern.findall(text.lower())
+
+
+def parse_document(line):
+    """Returns the (title, text) of a corpus line. Lines are either JSON
+    objects with a text and optional title field, or plain text.
+    """
+    line = line.strip()
+    if line.startswith("{"):
+        doc = json.loads(line)
+        return doc.get("title", ""), doc.get("text", "")
+    return "", line
+
+
+def tokenize_batch(lines):
+    """Worker side of the index build, parses and counts the terms of a batch
+    of corpus lines
+
+    Returns:
+        (List): of (title, text, term counts) for each non-empty document
+    """
+    docs = []
+    for line in lines:
+        title, text = parse_document(line)
+        if not text:
+            continue
+        docs.append((title, text,
+                     collections.Counter(tokenize(title + " " + text))))
+    return docs
+
+
+def read_batches(corpus_file):
+    """Streams the corpus in batches of lines
+    """
+    with open(corpus_file, encoding="utf-8") as fp:
+        batch = []
+        for line in fp:
+            batch.append(line)
+            if len(batch) == kBatchSize:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def write_run(path, postings):
+    """Writes in-memory postings to a run file, sorted by term
+    """
+    with open(path, "wb") as fp:
+        for term in sorted(postings):
+            encoded = term.encode("utf-8")
+            fp.write(kRunHeader.pack(len(encoded), len(postings[term])))
+            fp.write(encoded)
+            postings[term].tofile(fp)
+
+
+def read_run(path, run_index):
+    """Streams (term, run index, postings bytes) out of a run file
+    """
+    with open(path, "rb") as fp:
+        while True:
+            header = fp.read(kRunHeader.size)
+            if not header:
+                return
+            term_length, count = kRunHeader.unpack(header)
+            term = fp.read(term_length).decode("utf-8")
+            yield term, run_index, fp.read(count * 4)
+
+
+class IndexBuilder:
+    """Builds an on-disk inverted index from a corpus, one document per line.
+    Tokenizing runs on a process pool while documents stream through, and
+    postings are spilled to sorted run files which are merged at the end, so
+    memory stays bounded for multi-GB corpora.
+
+    Index directory layout:
+        docs.bin     utf-8 text of every document, back to back
+        docs.idx     uint64 offsets of each document in docs.bin
+        titles.json  title of every document
+        lengths.bin  uint32 length in tokens of every document
+        postings.bin uint32 (doc id, term frequency) pairs grouped by term
+        lexicon.json term -> [offset in postings.bin, document frequency]
+        meta.json    document count and average length
+    """
+
+    def __init__(self, index_dir, workers=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.index_dir = index_dir
+        self.workers = workers or os.cpu_count() or 1
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+    def path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def build(self, corpus_file):
+        """Builds the index for a corpus file
+        """
+        postings = collections.defaultdict(lambda: array.array("I"))
+        buffered = 0
+        runs = []
+        titles = []
+        offsets = array.array("Q", [0])
+        lengths = array.array("I")
+        total_length = 0
+        batches = read_batches(corpus_file)
+        with open(self.path("docs.bin"), "wb") as docs_fp, \
+                multiprocessing.Pool(self.workers) as pool:
+            for docs in self.tokenized(pool, batches):
+                for title, text, counts in docs:
+                    doc_id = len(lengths)
+                    encoded = text.encode("utf-8")
+                    docs_fp.write(encoded)
+                    offsets.append(offsets[-1] + len(encoded))
+                    titles.append(title)
+                    length = sum(counts.values())
+                    lengths.append(length)
+                    total_length += length
+                    for term, tf in counts.items():
+                        postings[term].extend((doc_id, tf))
+                    buffered += len(counts)
+                if buffered * 2 >= kSpillPostings:
+                    runs.append(self.spill(postings, len(runs)))
+                    buffered = 0
+                    self.logger.info("Indexed {} documents".format(
+                        len(lengths)))
+        if postings:
+            runs.append(self.spill(postings, len(runs)))
+
+        with open(self.path("docs.idx"), "wb") as fp:
+            offsets.tofile(fp)
+        with open(self.path("lengths.bin"), "wb") as fp:
+            lengths.tofile(fp)
+        with open(self.path("titles.json"), "w") as fp:
+            json.dump(titles, fp)
+        self.merge(runs)
+        with open(self.path("meta.json"), "w") as fp:
+            json.dump({"documents": len(lengths),
+                       "average_length": total_length / max(len(lengths), 1)},
+                      fp)
+        self.logger.info("Built index of {} documents in {}".format(
+            len(lengths), self.index_dir))
+
+    def tokenized(self, pool, batches):
+        """Tokenizes batches on the pool, in order. Pool.imap reads its whole
+        input up front, so batches are fed to it a window at a time.
+        """
+        while True:
+            window = list(itertools.islice(
+                batches, self.workers * kBatchesPerWorker))
+            if not window:
+                return
+            for docs in pool.imap(tokenize_batch, window):
+                yield docs
+
+    def spill(self, postings, run_index):
+        path = self.path("run_{}.bin".format(run_index))
+        write_run(path, postings)
+        postings.clear()
+        return path
+
+    def merge(self, runs):
+        """Merges the sorted run files into the final postings and lexicon.
+        Runs hold increasing doc ids, so a term's postings are concatenated in
+        run order.
+        """
+        lexicon = {}
+        offset = 0
+        merged = heapq.merge(*[read_run(path, i) for i, path in enumerate(runs)])
+        with open(self.path("postings.bin"), "wb") as fp:
+            current = None
+            for term, _, data in merged:
+                if term != current:
+                    current = term
+                    lexicon[term] = [offset, 0]
+                fp.write(data)
+                offset += len(data) // 4
+                lexicon[term][1] += len(data) // 8
+        for path in runs:
+            os.remove(path)
+        with open(self.path("lexicon.json"), "w") as fp:
+            json.dump(lexicon, fp)
+
+
+class Index:
+    """Read side of an index built by IndexBuilder. Postings and documents are
+    memory mapped, so only the lexicon is loaded up front.
+    """
+
+    def __init__(self, index_dir):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.index_dir = index_dir
+        with open(self.path("meta.json")) as fp:
+            meta = json.load(fp)
+        self.documents = meta["documents"]
+        self.average_length = meta["average_length"]
+        with open(self.path("lexicon.json")) as fp:
+            self.lexicon = json.load(fp)
+        with open(self.path("titles.json")) as fp:
+            self.titles = json.load(fp)
+        self.postings = self.map_array("postings.bin", np.uint32)
+        self.lengths = self.map_array("lengths.bin", np.uint32)
+        self.offsets = self.map_array("docs.idx", np.uint64)
+        self.docs_fp = open(self.path("docs.bin"), "rb")
+        self.docs = self.map_file(self.docs_fp)
+        self.logger.info("Loaded index of {} documents from {}".format(
+            self.documents, index_dir))
+
+    def path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def map_file(self, fp):
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def map_array(self, name, dtype):
+        with open(self.path(name), "rb") as fp:
+            return np.frombuffer(self.map_file(fp), dtype=dtype)
+
+    def search(self, query, limit=10, offset=0):
+        """Ranks documents against a query with BM25
+
+        Args:
+            query (String): free text query
+            limit (Number): of documents to return
+            offset (Number): of top ranked documents to skip
+        Returns:
+            (Tuple): of a list of (doc id, score) and the number of matches
+        """
+        doc_ids = []
+        scores = []
+        for term in set(tokenize(query)) - kStopWords:
+            entry = self.lexicon.get(term)
+            if entry is None:
+                continue
+            start, df = entry
+            idf = math.log(1 + (self.documents - df + 0.5) / (df + 0.5))
+            pairs = self.postings[start:start + 2 * df].reshape(-1, 2)
+            ids = pairs[:, 0]
+            tf = pairs[:, 1].astype(np.float64)
+            norm = kK1 * (1 - kB + kB * self.lengths[ids] / self.average_length)
+            doc_ids.append(ids)
+            scores.append(idf * tf * (kK1 + 1) / (tf + norm))
+        if not doc_ids:
+            return [], 0
+        ids, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        wanted = min(offset + limit, len(ids))
+        top = np.argpartition(-totals, wanted - 1)[:wanted]
+        top = top[np.argsort(-totals[top], kind="mergesort")][offset:]
+        return [(int(ids[i]), float(totals[i])) for i in top], len(ids)
+
+    def document(self, doc_id):
+        """Returns the (title, text) of a document
+        """
+        start = int(self.offsets[doc_id])
+        end = int(self.offsets[doc_id + 1])
+        return self.titles[doc_id], self.docs[start:end].decode("utf-8")
+
+    def close(self):
+        self.docs_fp.close()
+
+
+def main():
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description="Builds a local search index over a corpus file with one\
+         document per line, either plain text or JSON with text and title")
+    arg_parser.add_argument("--corpus", "-c", required=True,
+                            help="The corpus file")
+    arg_parser.add_argument("--index_dir", "-o", required=True,
+                            help="The directory to write the index to")
+    arg_parser.add_argument("--workers", "-w", type=int,
+                            help="Tokenizer processes (default: one per core)")
+    args = arg_parser.parse_args()
+    IndexBuilder(args.index_dir, args.workers).build(args.corpus)
+
+
+if __name__ == "__main__":
+    main()
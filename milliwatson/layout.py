@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import collections
+import configparser
+import json
+import logging
+import os
+
+import numpy as np
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kDefaultNumAnswers = 3
+# pixels darker than this are treated as text
+kBinaryThreshold = 200
+
+Region = collections.namedtuple("Region", ["name", "x", "y", "w", "h"])
+
+
+def load_config(config_file):
+    """Loads a phone config file
+
+    Returns:
+        (Dict): of config values, all converted to ints
+    """
+    config_parse = configparser.ConfigParser()
+    config_parse.read(config_file)
+    return dict((k, int(v)) for k, v in config_parse['DEFAULT'].items())
+
+
+class Layout:
+    """Every section rectangle of a phone config, computed once up front
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.num_answers = config.get('num_answers', kDefaultNumAnswers)
+        x = config['horizontal_padding'] + config['question_left_margin']
+        y = config['question_top_margin'] + config['vertical_padding']
+        w = config['capture_width'] - 2 * config['horizontal_padding'] - \
+            config['question_left_margin'] - config['question_right_margin']
+        self.question = Region("question", x, y, w, config['question_height'])
+
+        x = config['horizontal_padding'] + config['answer_left_margin']
+        y = self.question.y + self.question.h + \
+            config['answer_first_top_margin']
+        w = config['capture_width'] - 2 * config['horizontal_padding'] - \
+            config['answer_left_margin'] - config['answer_right_margin']
+        h = config['answer_height']
+        self.answers = [Region("answer_{}".format(i), x, y + i * h, w, h)
+                        for i in range(self.num_answers)]
+        self.regions = [self.question] + self.answers
+
+    @classmethod
+    def from_file(cls, config_file):
+        return cls(load_config(config_file))
+
+    def answer(self, index):
+        """Returns the region of an answer, zero based from the top
+        """
+        return self.answers[index]
+
+    def set_answers(self, boxes):
+        """Replaces the answer regions, e.g. with detected answer boxes
+
+        Args:
+            boxes (List): of (x, y, w, h), one per answer from the top
+        """
+        self.answers = [Region("answer_{}".format(i), *box)
+                        for i, box in enumerate(boxes)]
+        self.regions = [self.question] + self.answers
+
+    def load_geometry(self, path):
+        """Applies the answer boxes saved by save_geometry, if they were
+        detected with the same config
+
+        Returns:
+            (Bool): True if saved boxes were applied
+        """
+        if not os.path.exists(path):
+            return False
+        with open(path) as fp:
+            try:
+                saved = json.load(fp)
+            except ValueError:
+                return False
+        if saved.get('config') != self.config or \
+                len(saved.get('answers', [])) != self.num_answers:
+            return False
+        self.set_answers(saved['answers'])
+        return True
+
+    def save_geometry(self, path):
+        """Saves the answer boxes along with the config they were made for.
+        The file is replaced in one step, as several batch workers may save
+        it at once.
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump({'config': self.config,
+                       'answers': [list(r[1:]) for r in self.answers]}, fp)
+        os.replace(tmp_path, path)
+
+
+def bounding_region(regions):
+    """Returns the smallest (x0, y0, x1, y1) box enclosing all regions
+    """
+    return (min(r.x for r in regions), min(r.y for r in regions),
+            max(r.x + r.w for r in regions), max(r.y + r.h for r in regions))
+
+
+def binarize_regions(image, regions, threshold=kBinaryThreshold):
+    """Crops and binarizes several regions of an image in one pass.
+    Only the box enclosing the regions is converted to grayscale, then the
+    threshold runs once, vectorized, over that box.
+
+    Args:
+        image: PIL.Image of the full frame
+        regions (List): of Regions to extract
+        threshold (Number): grayscale value below which a pixel is text
+    Returns:
+        (List): of uint8 NumPy arrays, one per region, 0 for text 255 otherwise
+    """
+    x0, y0, x1, y1 = bounding_region(regions)
+    # PIL's own 'L' conversion, so pixels match convert('L') exactly
+    gray = np.asarray(image.crop((x0, y0, x1, y1)).convert("L"))
+    binary = np.where(gray < threshold, 0, 255).astype(np.uint8)
+    return [binary[r.y - y0:r.y - y0 + r.h, r.x - x0:r.x - x0 + r.w]
+            for r in regions]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import threading
+import time
+
+import backends
+import cache
+import metrics
+import query
+import store
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kDefaultConcurrency = 8
+# samples kept per stage, enough that every question of a run is counted in
+# the percentiles
+kSamples = 100000
+# saved questions loaded to replay at most
+kMaxQuestions = 1000
+
+
+class LoadTest:
+    """Drives the search, caching and scoring paths of WebQuery from several
+    threads at once against an http search backend, usually a stand-in
+    server, and measures throughput and tail latency
+    """
+
+    def __init__(self, url, questions, concurrency=kDefaultConcurrency,
+                 fanout=False, deadline=5.0, cache_size=0):
+        """
+        Args:
+            url (String): of the search server, http://<host>:<port>
+            questions (List): of dicts with a question and answers
+            concurrency (Number): of questions in flight at once
+            fanout (Bool): search the question with each answer too
+            deadline (Number): seconds to wait for fan-out searches
+            cache_size (Number): of searches cached in memory, 0 to not cache
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.questions = questions
+        self.concurrency = concurrency
+        self.fanout = fanout
+        self.deadline = deadline
+        self.metrics = metrics.Metrics(kSamples)
+        connections = concurrency
+        if fanout:
+            connections *= query.kMaxConcurrentRequests
+        self.backend = backends.HttpBackend(url, connections)
+        self.cache = None
+        if cache_size:
+            self.cache = cache.TieredCache(memory_size=cache_size)
+        self.lock = threading.Lock()
+        self.started = 0
+        self.errors = 0
+
+    def next_question(self, stop_at, limit):
+        """Returns the next question to ask, or None once the run is over
+        """
+        with self.lock:
+            if limit is not None and self.started >= limit:
+                return None
+            if stop_at is not None and time.perf_counter() >= stop_at:
+                return None
+            question = self.questions[self.started % len(self.questions)]
+            self.started += 1
+        return question
+
+    def worker(self, stop_at, limit):
+        # WebQuery keeps the last question's results, so one per thread
+        wb = query.WebQuery(self.backend, self.cache, self.metrics)
+        wb.open_browser = False
+        while True:
+            data = self.next_question(stop_at, limit)
+            if data is None:
+                return
+            with self.metrics.stage("total"):
+                if self.fanout:
+                    ok = wb.search_fanout(data['question'], data['answers'],
+                                          deadline=self.deadline)
+                else:
+                    ok = wb.search_google(data['question'])
+                if ok:
+                    wb.answer_frequency(data['answers'])
+                    wb.answer_frequency_fuzzy(data['answers'])
+            if not ok:
+                with self.lock:
+                    self.errors += 1
+
+    def run(self, duration=None, limit=None):
+        """Asks questions from every thread until the duration is up or the
+        limit of questions is reached
+
+        Args:
+            duration (Number): seconds to run for, None for no time limit
+            limit (Number): of questions to ask, None for no limit
+        Returns:
+            (Dict): the report
+        """
+        self.backend.warm_up()
+        start = time.perf_counter()
+        stop_at = start + duration if duration is not None else None
+        threads = [threading.Thread(target=self.worker, args=(stop_at, limit))
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        stages = {}
+        for name, histogram in self.metrics.histograms.items():
+            stages[name] = {
+                "count": histogram.count,
+                "p50_ms": 1000.0 * histogram.percentile(0.5),
+                "p95_ms": 1000.0 * histogram.percentile(0.95),
+                "p99_ms": 1000.0 * histogram.percentile(0.99),
+            }
+        return {
+            "questions": self.started,
+            "errors": self.errors,
+            "concurrency": self.concurrency,
+            "seconds": elapsed,
+            "questions_per_second": self.started / elapsed if elapsed else 0.0,
+            "stages": stages,
+            "cache": self.cache.stats() if self.cache is not None else None,
+        }
+
+    def close(self):
+        self.backend.close()
+
+
+def print_report(report):
+    print("{:<24}{:>8}{:>10}{:>10}{:>10}".format(
+        "stage", "count", "p50 ms", "p95 ms", "p99 ms"))
+    for name, stage in report["stages"].items():
+        print("{:<24}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            name, stage["count"], stage["p50_ms"], stage["p95_ms"],
+            stage["p99_ms"]))
+    print("Questions: {} in {:.1f}s ({:.2f}/s) from {} threads, "
+          "failed: {}".format(report["questions"], report["seconds"],
+                              report["questions_per_second"],
+                              report["concurrency"], report["errors"]))
+    if report["cache"] is not None:
+        print("Search cache: {}".format(report["cache"]))
+
+
+def main():
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description="Load tests searching and scoring against an http search \
+        server, such as standin")
+    arg_parser.add_argument("--search", required=True,
+                            help="The search server, http://<host>:<port>")
+    arg_parser.add_argument("--results", default="results/results.db",
+                            help="The result store to take questions from "
+                            "(default: results/results.db)")
+    arg_parser.add_argument("--concurrency", "-c", type=int,
+                            default=kDefaultConcurrency,
+                            help="Questions in flight at once (default: 8)")
+    arg_parser.add_argument("--duration", type=float,
+                            help="Seconds to run for")
+    arg_parser.add_argument("--requests", "-n", type=int,
+                            help="Questions to ask, one pass over the saved "
+                            "questions if neither this nor --duration is set")
+    arg_parser.add_argument("--fanout", action='store_true',
+                            help="Fan out searches to each answer")
+    arg_parser.add_argument("--deadline", type=float, default=5.0,
+                            help="Seconds to wait for fan-out searches "
+                            "(default: 5)")
+    arg_parser.add_argument("--cache_size", type=int, default=0,
+                            help="Searches to cache in memory, 0 to search "
+                            "every time (default: 0)")
+    arg_parser.add_argument("--report", help="Write the report as JSON here")
+    args = arg_parser.parse_args()
+    # the per question logging of WebQuery would swamp the report
+    logging.getLogger().setLevel(logging.WARNING)
+
+    result_store = store.ResultStore(args.results)
+    try:
+        questions = result_store.recent(kMaxQuestions)
+    finally:
+        result_store.close()
+    if not questions:
+        arg_parser.error("No saved questions in {}".format(args.results))
+    limit = args.requests
+    if limit is None and args.duration is None:
+        limit = len(questions)
+
+    load_test = LoadTest(args.search, questions, args.concurrency,
+                         args.fanout, args.deadline, args.cache_size)
+    try:
+        report = load_test.run(args.duration, limit)
+    finally:
+        load_test.close()
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
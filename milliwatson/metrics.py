@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+# samples kept per stage for the rolling percentiles
+kWindow = 1000
+kQuantiles = [0.5, 0.95, 0.99]
+
+
+class Histogram:
+    """Rolling window of the latest samples of one stage, plus lifetime totals
+    """
+
+    def __init__(self, window=kWindow):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q):
+        """Returns the q (0-1) quantile of the window, in seconds
+        """
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Metrics:
+    """Times pipeline stages with perf_counter and keeps a rolling histogram
+    per stage. Timings can also be added to a question's record, so they are
+    saved alongside its results.
+    """
+
+    def __init__(self, window=kWindow):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.window = window
+        self.histograms = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # several writer threads may export at once
+        self.export_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, record=None):
+        """Context manager timing the enclosed block as a stage
+
+        Args:
+            name (String): of the stage
+            record (Dict): of the question to also add the timing to, in ms
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, record)
+
+    def observe(self, name, seconds, record=None):
+        with self.lock:
+            # stages running on several threads may share a record
+            if record is not None:
+                record[name] = record.get(name, 0.0) + seconds * 1000.0
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.window)
+            histogram.observe(seconds)
+
+    def summary(self):
+        """Returns a table of the p50/p95/p99 latency of every stage
+        """
+        lines = ["{:<24}{:>8}{:>10}{:>10}{:>10}".format(
+            "stage", "count", "p50 ms", "p95 ms", "p99 ms")]
+        with self.lock:
+            for name, histogram in self.histograms.items():
+                lines.append("{:<24}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                    name, histogram.count,
+                    *[histogram.percentile(q) * 1000.0 for q in kQuantiles]))
+        return "\n".join(lines)
+
+    def prometheus(self, prefix="milliwatson"):
+        """Returns every stage histogram in the Prometheus text format
+        """
+        metric = "{}_stage_seconds".format(prefix)
+        lines = ["# TYPE {} summary".format(metric)]
+        with self.lock:
+            for name, histogram in self.histograms.items():
+                for q in kQuantiles:
+                    lines.append("{}{{stage=\"{}\",quantile=\"{}\"}} {:.6f}".format(
+                        metric, name, q, histogram.percentile(q)))
+                lines.append("{}_sum{{stage=\"{}\"}} {:.6f}".format(
+                    metric, name, histogram.total))
+                lines.append("{}_count{{stage=\"{}\"}} {}".format(
+                    metric, name, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, record=None):
+        """Exports metrics to a file. A .prom file is rewritten with the
+        Prometheus text of every stage, any other file has the record appended
+        to it as a JSON line.
+        """
+        with self.export_lock:
+            if path.endswith(".prom"):
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w") as fp:
+                    fp.write(self.prometheus())
+                # replace in one step so scrapers never see a partial file
+                os.replace(tmp_path, path)
+            elif record is not None:
+                with open(path, "a") as fp:
+                    fp.write(json.dumps(record) + "\n")
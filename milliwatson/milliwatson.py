@@ -1,148 +1,463 @@
 #!/usr/bin/env python3
 
+import time
+# taken before any other import, so startup can report how long they took
+kImportStart = time.perf_counter()
+
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import importlib
 import os
 import sys
-import time
 import logging
-import select
 import tty
-import json
 import signal
 import termios
-import threading
 import uuid
 
+import backends
+import cache
+import change
+import engine
+import metrics
+import normalize
 import ocr
+import ocrcache
 import query
+import scoring
+import storage
+import store
 
 logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
 
 kResultsFolder = "results"
 kImagesFolder = "images"
+kCacheFolder = "cache"
+kResultsStore = kResultsFolder + "/results.db"
+# seconds between frames in auto capture
+kAutoInterval = 0.2
+# frames waiting to be saved, beyond this the frames of new questions are
+# dropped (their results are still saved) rather than piling up in memory
+kMaxPendingFrames = 8
+kWriterThreads = 2
+
+
+def timed_imports(names, metrics, record=None):
+    """Imports modules that are otherwise only imported on first use, timing
+    each one as an import_<module> stage
+
+    Args:
+        names (List): of the modules to import
+        metrics (Metrics): to time the imports with
+        record (Dict): to add the time of each import to, in ms
+    """
+    for name in names:
+        with metrics.stage("import_" + name.replace(".", "_"), record):
+            try:
+                importlib.import_module(name)
+            except ImportError as e:
+                logging.getLogger("MilliWatson").warning(
+                    "Unable to import {}: {}".format(name, e))
 
 
 class MilliWatson:
+    """Runs capture, OCR, search and persistence as asyncio stages joined by
+    bounded queues. Each stage handles one question at a time, so the next
+    frame can be captured and OCR'd while the previous question's search is
+    still in flight. Every question travels through the stages as its own
+    dict, so no stage shares mutable state with another.
 
-    def __init__(self, config_file):
+    Each instance is one session, capturing from one device. Several sessions
+    can run in one process with run_sessions, sharing the resources of Shared.
+    """
+
+    def __init__(self, config_file, shared, frame_source=None, fanout=False,
+                 deadline=5.0, budget=None, tight_crop=True,
+                 detect_answers=False, name=None):
+        """
+        Args:
+            config_file (String): the phone config file of the device
+            shared (Shared): resources shared with the other sessions
+            frame_source (String): spec of the device's frame source
+            name (String): to tell sessions apart in the log
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.ocr = ocr.OCR(config_file)
-        self.wb = query.WebQuery()
+        if name is not None:
+            self.logger = logging.getLogger("{}.{}".format(
+                self.__class__.__name__, name))
+        self.shared = shared
+        self.fanout = fanout
+        self.deadline = deadline
+        self.budget = budget
+        self.metrics = shared.metrics
+        self.store = shared.store
+        layout_cache = None
+        if detect_answers:
+            layout_cache = kCacheFolder + "/layout_{}.json".format(
+                os.path.basename(config_file))
+        self.ocr = ocr.OCR(config_file, frame_source=frame_source,
+                           metrics=self.metrics, tight_crop=tight_crop,
+                           layout_cache=layout_cache, pool=shared.ocr_pool)
+        self.wb = query.WebQuery(shared.backend, shared.search_cache,
+                                 self.metrics, shared.expand, shared.fetcher,
+                                 number_words=shared.number_words)
+        self.gate = change.QuestionGate()
+        # the last question to make it through the pipeline
         self.data = {}
+        self.last_question = None
         self.running = False
-        self.exiting = False
 
-        # create working directories if they don't already exist
-        self.create_directory(kResultsFolder)
-        self.create_directory(kImagesFolder)
-
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGTERM, self.signal_handler)
-        signal.signal(signal.SIGHUP, self.signal_handler)
-
-        self.t = threading.Thread(target=self.getInput)
-        self.t.setDaemon(True)
-        self.t.start()
-
-        # start main capture loop
-        self.run_loop()
-
-    def getInput(self):
-        self.logger.info("Monitoring keyboard commands: c - capture")
-        with NonBlockingConsole() as nbc:
-            while not self.exiting:
-                ch = nbc.get_data()
-                if ch == 'c':  # fwd
-                    self.logger.info("Capturing one...")
-                    self.capture()
-                    self.process_capture()
-                if ch == 'a':
-                    self.logger.info("Auto capture started")
-                    self.running = True
-                if ch == 's':
-                    self.logger.info("Auto capture stopped")
-                    self.running = False
-                time.sleep(0.01)
+    def warm_up(self, record=None):
+        """Opens the frame source and primes cropping, the search backend and
+        scoring, so the first question is as fast as any other
 
-    def run_loop(self):
-        while not self.exiting:
-            if self.running:
-                self.capture()
-                # check for validity here
-            time.sleep(0.2)
+        Args:
+            record (Dict): to add the time of each part to, in ms
+        """
+        # modules imported on first use, loaded here so their import time is
+        # reported on its own
+        modules = []
+        if self.ocr.tight_crop or self.ocr.detect_answers:
+            modules.append("detect")
+        if self.wb.backend.name == "google":
+            modules.append("google.google")
+        if scoring.rapid_process is None:
+            modules.append("fuzzywuzzy.fuzz")
+        timed_imports(modules, self.metrics, record)
+        with self.metrics.stage("warm_up_frames", record):
+            self.ocr.open_frame_source().warm_up()
+        with self.metrics.stage("warm_up_crop", record):
+            self.ocr.warm_up()
+        with self.metrics.stage("warm_up_search", record):
+            try:
+                self.wb.warm_up()
+            except Exception as e:
+                self.logger.warning("Unable to warm up search: {}".format(e))
+
+    def start(self):
+        """Starts the pipeline stages on the running event loop
+        """
+        self.loop = asyncio.get_running_loop()
+        self.triggers = asyncio.Queue()
+        self.ocr_queue = asyncio.Queue(maxsize=1)
+        self.query_queue = asyncio.Queue(maxsize=1)
+        # results are small, so the queue is unbounded and never blocks the
+        # search stage, only the frames waiting to be saved are bounded
+        self.persist_queue = asyncio.Queue()
+        self.pending_frames = 0
+        self.stages = [asyncio.ensure_future(self.capture_stage()),
+                       asyncio.ensure_future(self.ocr_stage()),
+                       asyncio.ensure_future(self.search_stage())]
+        self.persist_task = asyncio.ensure_future(self.persist_stage())
+
+    async def stop(self):
+        """Stops the pipeline once every answered question is saved
+        """
+        self.running = False
+        for stage in self.stages:
+            stage.cancel()
+        await asyncio.gather(*self.stages, return_exceptions=True)
+        # finish saving questions that were already answered
+        await self.persist_queue.join()
+        self.persist_task.cancel()
 
     def capture(self):
-        # this is setup for iPhoneX
-        self.ocr.capture_screen()
+        self.logger.info("Capturing one...")
+        self.triggers.put_nowait(True)
 
-    def process_capture(self):
-        id = uuid.uuid1()
-        if not self.run_ocr(id):
-            return False
-        if not self.run_query(self.data):
+    def start_auto(self):
+        self.logger.info("Auto capture started")
+        self.running = True
+        self.triggers.put_nowait(False)
+
+    def stop_auto(self):
+        self.logger.info("Auto capture stopped")
+        self.running = False
+
+    def close(self):
+        self.ocr.close()
+
+    async def next_capture(self):
+        """Waits until the next frame should be captured
+
+        Returns:
+            (Bool): True if the capture was asked for with 'c'
+        """
+        if not self.running:
+            return await self.triggers.get()
+        if getattr(self.ocr.frame_source, 'paced', False):
+            # the source waits for its next frame, e.g. video, so grab at once
+            await asyncio.sleep(0)
+            return not self.triggers.empty() and self.triggers.get_nowait()
+        try:
+            return await asyncio.wait_for(self.triggers.get(), kAutoInterval)
+        except asyncio.TimeoutError:
             return False
-        self.save_data(self.data)
-        filename = kImagesFolder + "/capture_{}".format(id)
-        self.ocr.save_image(filename)
-        return True
 
-    def run_ocr(self, id):
+    async def capture_stage(self):
+        while True:
+            manual = await self.next_capture()
+            if not manual and not self.running:
+                continue
+            start = time.time()
+            timings = {}
+            frame = await self.loop.run_in_executor(
+                None, self.ocr.grab_frame, timings)
+            if frame is None:
+                if self.running:
+                    self.logger.info("Auto capture stopped")
+                self.running = False
+                continue
+            if not manual:
+                section = self.ocr.question_image(frame)
+                is_new = await self.loop.run_in_executor(
+                    None, self.gate.update, section, frame)
+                if not is_new:
+                    continue
+                # the sharpest frame since the question card appeared
+                frame = self.gate.keyframe
+            await self.ocr_queue.put({'frame': frame, 'start': start,
+                                      'timings': timings,
+                                      'skip_repeats': not manual,
+                                      'data': {'id': str(uuid.uuid1())}})
+
+    async def ocr_stage(self):
+        while True:
+            item = await self.ocr_queue.get()
+            if await self.loop.run_in_executor(None, self.run_ocr, item):
+                await self.query_queue.put(item)
+
+    async def search_stage(self):
+        while True:
+            item = await self.query_queue.get()
+            if await self.loop.run_in_executor(None, self.answer, item):
+                if item['frame'] is not None:
+                    if self.pending_frames >= kMaxPendingFrames:
+                        self.logger.warning("Writes are backed up, not "
+                                            "saving the frame of {}".format(
+                                                item['data']['id']))
+                        item['frame'] = None
+                    else:
+                        self.pending_frames += 1
+                self.persist_queue.put_nowait(item)
+
+    async def persist_stage(self):
+        # writes are handed to the writer pool without waiting for the
+        # previous one, so they run on all of its threads
+        while True:
+            item = await self.persist_queue.get()
+            future = self.loop.run_in_executor(self.shared.writer,
+                                               self.persist, item)
+            future.add_done_callback(functools.partial(self.persisted, item))
+
+    def persisted(self, item, future):
+        """Called on the event loop once a question is saved
+        """
+        if item['frame'] is not None:
+            self.pending_frames -= 1
+        if future.exception() is not None:
+            self.logger.error("Error saving results {}".format(
+                future.exception()))
+        self.persist_queue.task_done()
+
+    def run_ocr(self, item):
+        data = item['data']
         try:
-            self.data['question'] = self.clense(self.ocr.get_question())
-            self.data['answers'] = []
-            self.data['answers'].append(self.clense(self.ocr.get_answer_A()))
-            self.data['answers'].append(self.clense(self.ocr.get_answer_B()))
-            self.data['answers'].append(self.clense(self.ocr.get_answer_C()))
-            self.data['id'] = str(id)
-            return True
+            question, *answers = self.ocr.ocr_frame(item['frame'],
+                                                    item['timings'])
+            data['question'] = normalize.normalize(question)
+            data['answers'] = [normalize.normalize(a) for a in answers]
         except Exception as e:
             self.logger.error("Error parsing image {}".format(e))
-        return False
-
-    def clense(self, in_string):
-        # remove hyphens followed by spaces
-        in_string = in_string.replace("-", "")
-        # remove special characters
-        in_string = in_string.replace("|", "I")
-        # convert all lower
-        in_string = in_string.lower()
-        # convert digits to text
-        words = in_string.split(" ")
-        words_no_digits = []
-        for word in words:
-            try:
-                words_no_digits.append(int(word))
-            except Exception as e:
-                words_no_digits.append(word)
-        return " ".join(words_no_digits)
+            return False
+        question = (data['question'], data['answers'])
+        if item['skip_repeats'] and question == self.last_question:
+            self.logger.info("Skipping repeated question")
+            return False
+        self.last_question = question
+        with self.metrics.stage("lookup", item['timings']):
+            item['previous'] = self.store.lookup(data['question'],
+                                                 data['answers'])
+        return True
+
+    def answer(self, item):
+        """Answers a question from the store if it was seen before, otherwise
+        by searching. Runs on the search stage only, as WebQuery holds the
+        state of the query in progress.
+        """
+        if item['previous'] is not None:
+            self.answer_from_store(item['data'], item['previous'])
+            return True
+        self.wb.record = item['timings']
+        with self.metrics.stage("query", item['timings']):
+            return self.run_query(item['data'], item['start'])
+
+    def answer_from_store(self, data, previous):
+        self.logger.info("Seen this question before, answering from {}".format(
+            previous['id']))
+        # marks any inversion so the stored counts rank the same way
+        self.wb.prepare_query(data['question'])
+        data['results'] = self.wb.rank_counts(
+            dict(previous['results']), "Stored results")
+        data['answered_from'] = previous['id']
 
-    def run_query(self, data):
-        if not self.wb.search_google(data['question']):
+    def run_query(self, data, start):
+        if self.budget is not None:
+            # whatever capture and OCR didn't use of the budget goes to search
+            remaining = self.budget - (time.time() - start)
+            data['results'] = self.wb.answer_progressive(
+                data['question'], data['answers'], deadline=max(remaining, 0))
+            data['hits'] = self.wb.answer_hits(data['answers'])
+            data['evidence'] = self.wb.evidence()
+            return self.wb.completed > 0
+        if self.fanout:
+            if not self.wb.search_fanout(data['question'], data['answers'],
+                                         deadline=self.deadline):
+                return False
+            data['hits'] = self.wb.answer_hits(data['answers'])
+        elif not self.wb.search_google(data['question']):
             return False
         counts = self.wb.answer_frequency_fuzzy(data['answers'])
-        self.data['results'] = counts
+        data['results'] = counts
         return True
 
+    def persist(self, item):
+        data = item['data']
+        data['timings'] = item['timings']
+        if item['frame'] is not None:
+            with self.metrics.stage("save_frame", item['timings']):
+                self.shared.frame_writer.save(item['frame'], data['id'],
+                                              self.ocr.layout.regions)
+        # the results are serialized as they're saved, so only the metrics
+        # export has the time taken to save them
+        with self.metrics.stage("save_results", item['timings']):
+            self.save_data(data)
+        if self.shared.metrics_file:
+            self.metrics.export(self.shared.metrics_file, {
+                'id': data['id'], 'timings': data['timings']})
+        self.data = data
+
     def show_data(self):
         print(self.data)
 
     def save_data(self, data):
-        filename = kResultsFolder + "/results_{}.json".format(data['id'])
-        with open(filename, 'w') as fp:
-            json.dump(data, fp, indent=4)
-        self.logger.info("Saved results to {}".format(filename))
+        self.store.append(data)
+        self.logger.info("Saved results {} to {}".format(data['id'],
+                                                         kResultsStore))
 
-    def signal_handler(self, s, f):
-        self.logger.info("Exiting!")
-        self.running = False
-        self.exiting = True
 
-    def create_directory(self, path):
-        if not os.path.exists(path):
-            os.makedirs(path)
+class Shared:
+    """Resources shared by every session of a process: the OCR worker pool,
+    the search backend and its cache, the result store and metrics. Searches
+    go through a CoalescingBackend, so when several devices show the same
+    question at once it is only searched for once.
+    """
+
+    def __init__(self, engine_name="auto", workers=None, cache_ttl=30,
+                 search="google", metrics_file=None, record_searches=None,
+                 ocr_cache="exact", expand=0, storage_policy="full",
+                 png_level=storage.kDefaultPNGLevel, number_words=False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        # create working directories if they don't already exist
+        for path in [kResultsFolder, kImagesFolder, kCacheFolder]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        self.metrics = metrics.Metrics()
+        self.metrics_file = metrics_file
+        self.ocr_pool = ocr.OCRPool(engine_name, workers,
+                                    ocrcache.make_ocr_cache(
+                                        ocr_cache, kCacheFolder + "/ocr.db"))
+        self.search_cache = cache.TieredCache(
+            kCacheFolder + "/search.db", ttl=cache_ttl * 24 * 60 * 60)
+        self.backend = backends.CoalescingBackend(
+            backends.make_backend(search, record_searches))
+        self.store = store.ResultStore(kResultsStore)
+        self.frame_writer = storage.FrameWriter(kImagesFolder, storage_policy,
+                                                png_level)
+        # writes get their own threads, so they never hold up the pipeline's
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=kWriterThreads)
+        self.expand = expand
+        self.number_words = number_words
+        self.fetcher = None
+        if expand:
+            # imported here, requests is only needed to expand results
+            import pages
+            self.fetcher = pages.PageFetcher()
+
+    def warm_up(self, record=None):
+        """Starts the OCR workers and primes tesseract
+
+        Args:
+            record (Dict): to add the time taken to, in ms
+        """
+        if self.ocr_pool.engine.name == "pytesseract":
+            timed_imports(["pytesseract"], self.metrics, record)
+        with self.metrics.stage("warm_up_ocr", record):
+            self.ocr_pool.warm_up()
+
+    def print_summary(self):
+        print(self.metrics.summary())
+        if self.ocr_pool.ocr_cache is not None:
+            print("OCR cache: {}".format(self.ocr_pool.ocr_cache.stats()))
+        print("Search cache: {}, {} searches coalesced".format(
+            self.search_cache.stats(), self.backend.coalesced))
+
+    def close(self):
+        self.ocr_pool.close()
+        self.logger.info("Search cache: {}".format(self.search_cache.stats()))
+        self.search_cache.close()
+        self.backend.close()
+        if self.fetcher is not None:
+            self.fetcher.close()
+        self.writer.shutdown()
+        self.store.close()
+
+
+async def run_sessions(sessions, shared):
+    """Runs sessions until SIGINT, SIGTERM or SIGHUP. Keys pressed apply to
+    every session.
+    """
+    logger = logging.getLogger("MilliWatson")
+    loop = asyncio.get_running_loop()
+    exiting = asyncio.Event()
+
+    def on_signal():
+        logger.info("Exiting!")
+        exiting.set()
+
+    def on_key():
+        ch = sys.stdin.read(1)
+        for session in sessions:
+            if ch == 'c':  # fwd
+                session.capture()
+            if ch == 'a':
+                session.start_auto()
+            if ch == 's':
+                session.stop_auto()
+        if ch == 'm':
+            shared.print_summary()
+
+    for s in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+        loop.add_signal_handler(s, on_signal)
+    for session in sessions:
+        session.start()
+    logger.info("Monitoring keyboard commands: c - capture, "
+                "a/s - start/stop auto capture, m - metrics")
+    with NonBlockingConsole():
+        loop.add_reader(sys.stdin.fileno(), on_key)
+        await exiting.wait()
+        loop.remove_reader(sys.stdin.fileno())
+    await asyncio.gather(*[session.stop() for session in sessions])
 
 
 class NonBlockingConsole(object):
+    """Puts the terminal in cbreak mode, so keys are readable one at a time
+    as soon as they are pressed
+    """
 
     def __enter__(self):
         self.old_settings = termios.tcgetattr(sys.stdin)
@@ -152,18 +467,108 @@ class NonBlockingConsole(object):
     def __exit__(self, type, value, traceback):
         termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.old_settings)
 
-    def get_data(self):
-        if select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], []):
-            return sys.stdin.read(1)
-        return False
-
 
 if __name__ == "__main__":
+    imported = time.perf_counter()
     arg_parser = argparse.ArgumentParser(
         description="The newest pint-sized trivia super star")
     arg_parser.add_argument("--config_file", "-f",
                             help="The phone config file (default: iphone_x_macpro_2880x1800)",
                             default="configs/iphone_x_macpro_2880x1800")
+    arg_parser.add_argument("--engine", "-e", choices=engine.kEngines,
+                            help="The OCR engine (default: auto)",
+                            default="auto")
+    arg_parser.add_argument("--source", help="The frame source to capture from: "
+                            "screencapture, replay[:<glob>], "
+                            "x11[:<x>,<y>,<w>,<h>] or "
+                            "video:<file or device>[@<skip>] "
+                            "(default: platform specific)")
+    arg_parser.add_argument("--session", action='append',
+                            help="Run a session for another device, as "
+                            "<config file>[,<frame source>]. May be given "
+                            "several times, overrides --config_file and "
+                            "--source")
+    arg_parser.add_argument("--workers", type=int,
+                            help="Sections OCR'd at once across all sessions "
+                            "(default: one per core)")
+    arg_parser.add_argument("--fanout", action='store_true',
+                            help="Search the question and each answer concurrently")
+    arg_parser.add_argument("--deadline", type=float, default=5.0,
+                            help="Seconds to wait for fan-out searches (default: 5)")
+    arg_parser.add_argument("--cache_ttl", type=float, default=30,
+                            help="Days to keep cached search results (default: 30)")
+    arg_parser.add_argument("--search", default="google",
+                            help="The search backend: google, "
+                            "local:<index directory>, replay:<recording file> "
+                            "or http://<host>:<port> (default: google)")
+    arg_parser.add_argument("--expand", type=int, default=0,
+                            help="Fetch the pages of this many top results "
+                            "and score their full text (default: 0)")
+    arg_parser.add_argument("--budget", type=float,
+                            help="Seconds per question; answers progressively "
+                            "as results arrive and stops searching when spent")
+    arg_parser.add_argument("--metrics_file",
+                            help="Export stage timings after each question: "
+                            "Prometheus text for a .prom file, JSON lines "
+                            "otherwise")
+    arg_parser.add_argument("--record_searches",
+                            help="Append every search and its results to this "
+                            "file, for replay with --search replay:<file>")
+    arg_parser.add_argument("--ocr_cache", choices=ocrcache.kModes,
+                            default="exact",
+                            help="Reuse OCR text of sections seen before, "
+                            "perceptual also matches near identical ones "
+                            "(default: exact)")
+    arg_parser.add_argument("--no_tight_crop", action='store_true',
+                            help="OCR the configured sections as they are, "
+                            "without cropping to the text")
+    arg_parser.add_argument("--detect_answers", action='store_true',
+                            help="Detect the answer boxes on the first frame "
+                            "and reuse them for this config")
+    arg_parser.add_argument("--storage", choices=storage.kPolicies,
+                            default="full",
+                            help="What to save of each question's frame: the "
+                            "full frame, annotated with the sections, only "
+                            "the section crops, downscaled, or none "
+                            "(default: full)")
+    arg_parser.add_argument("--png_level", type=int,
+                            default=storage.kDefaultPNGLevel,
+                            help="PNG compression level 0-9, higher is smaller "
+                            "but slower (default: 1)")
+    arg_parser.add_argument("--number_words", action='store_true',
+                            help="Spell out numbers when scoring, so digits "
+                            "and words match each other")
     args = arg_parser.parse_args()
 
-    mW = MilliWatson(args.config_file)
+    devices = [(args.config_file, args.source)]
+    if args.session:
+        devices = [(config_file, source or None) for config_file, _, source
+                   in (spec.partition(",") for spec in args.session)]
+
+    shared = Shared(args.engine, args.workers, args.cache_ttl, args.search,
+                    args.metrics_file, args.record_searches, args.ocr_cache,
+                    args.expand, args.storage, args.png_level,
+                    args.number_words)
+    sessions = []
+    try:
+        for i, (config_file, source) in enumerate(devices):
+            sessions.append(MilliWatson(
+                config_file, shared, source, args.fanout, args.deadline,
+                args.budget, not args.no_tight_crop, args.detect_answers,
+                name=str(i) if len(devices) > 1 else None))
+        # everything the first question would otherwise pay for is done
+        # before capture is armed
+        startup = collections.OrderedDict()
+        shared.metrics.observe("import", imported - kImportStart, startup)
+        shared.warm_up(startup)
+        for session in sessions:
+            session.warm_up(startup)
+        logging.getLogger("MilliWatson").info("Started up in {:.0f} ms: {}".format(
+            sum(startup.values()), ", ".join(
+                "{} {:.0f} ms".format(k, v) for k, v in startup.items())))
+        asyncio.run(run_sessions(sessions, shared))
+    finally:
+        for session in sessions:
+            session.close()
+        shared.close()
+    print(shared.metrics.summary())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import logging
+import re
+import unicodedata
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+# blocks of combining marks, dropped once decomposed so accents fold away
+kCombiningRanges = [(0x0300, 0x0370), (0x1AB0, 0x1B00), (0x1DC0, 0x1E00),
+                    (0x20D0, 0x2100), (0xFE20, 0xFE30)]
+# characters OCR and typesetting substitute for plain ones
+kSubstitutions = {
+    "|": "I",
+    # quotes
+    "\u2018": "'", "\u2019": "'", "\u201a": "'", "\u2032": "'",
+    "\u201c": "\"", "\u201d": "\"", "\u201e": "\"", "\u2033": "\"",
+    # dashes and minus
+    "\u2010": "-", "\u2011": "-", "\u2012": "-", "\u2013": "-",
+    "\u2014": "-", "\u2212": "-",
+    # soft hyphen
+    "\u00ad": "",
+}
+kTable = str.maketrans(dict(
+    [(chr(c), None) for start, end in kCombiningRanges
+     for c in range(start, end)] + list(kSubstitutions.items())))
+# a word broken over two lines, "hyphen- ated", then any hyphen left
+kHyphens = re.compile(r"(?<=\w)-\s+(?=\w)|-")
+# an integer, with or without thousands separators, and any decimal part
+kNumber = re.compile(r"\b(\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d+))?\b")
+# numbers longer than this stay as digits
+kMaxNumberDigits = 12
+# four digit numbers in this range are read as years, "nineteen fifty six"
+kYears = (1100, 2000)
+
+kOnes = ["zero", "one", "two", "three", "four", "five", "six", "seven",
+         "eight", "nine", "ten", "eleven", "twelve", "thirteen", "fourteen",
+         "fifteen", "sixteen", "seventeen", "eighteen", "nineteen"]
+kTens = ["", "", "twenty", "thirty", "forty", "fifty", "sixty", "seventy",
+         "eighty", "ninety"]
+kScales = [(10 ** 9, "billion"), (10 ** 6, "million"), (1000, "thousand"),
+           (100, "hundred")]
+
+
+def normalize(text):
+    """Normalizes OCR output or search text for matching, in one pass of each
+    step: unicode compatibility forms (e.g. ligatures) are decomposed and
+    accents dropped, OCR confusions and typographic punctuation mapped, case
+    folded, hyphens removed and whitespace collapsed.
+
+    Args:
+        text (String): to normalize
+    Returns:
+        (String): the normalized text
+    """
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+    text = text.translate(kTable).lower()
+    return " ".join(kHyphens.sub("", text).split())
+
+
+def number_to_words(number):
+    """Spells out a non-negative int, e.g. 1956 as
+    one thousand nine hundred fifty six
+    """
+    if number < 20:
+        return kOnes[number]
+    if number < 100:
+        words = kTens[number // 10]
+        if number % 10:
+            words += " " + kOnes[number % 10]
+        return words
+    for scale, name in kScales:
+        if number >= scale:
+            words = "{} {}".format(number_to_words(number // scale), name)
+            if number % scale:
+                words += " " + number_to_words(number % scale)
+            return words
+
+
+def year_to_words(year):
+    """Spells out a year the way it's said, e.g. 1905 as nineteen oh five
+    """
+    century, rest = divmod(year, 100)
+    if rest == 0:
+        return "{} hundred".format(number_to_words(century))
+    if rest < 10:
+        return "{} oh {}".format(number_to_words(century), kOnes[rest])
+    return "{} {}".format(number_to_words(century), number_to_words(rest))
+
+
+def numbers_to_words(text):
+    """Spells out every number of normalized text, so digits and words
+    compare equal. Decimals are read digit by digit, 3.25 as three point
+    two five.
+    """
+    def spell(match):
+        integer, decimals = match.group(1), match.group(2)
+        digits = integer.replace(",", "")
+        if len(digits) > kMaxNumberDigits:
+            return match.group(0)
+        if decimals is not None:
+            return "{} point {}".format(number_to_words(int(digits)),
+                                        " ".join(kOnes[int(d)]
+                                                 for d in decimals))
+        if digits == integer and len(digits) == 4 and \
+                kYears[0] <= int(digits) < kYears[1]:
+            return year_to_words(int(digits))
+        return number_to_words(int(digits))
+    return kNumber.sub(spell, text)
@@ -1,14 +1,70 @@
 #!/usr/bin/env python3
 
-import configparser
+import concurrent.futures
+import glob
+import json
+import multiprocessing
+import numpy as np
 from PIL import Image
-from PIL import ImageDraw
-import pytesseract
 import os
-import cv2
 import logging
+import sys
+import threading
+
+import engine
+import frames
+import layout
+from metrics import Metrics
+from storage import annotate
 
 logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+# the question wraps over several lines, each answer fits on one
+kQuestionPSM = engine.kPSMBlock
+kAnswerPSM = engine.kPSMLine
+
+
+class OCRPool:
+    """The worker threads, tesseract engine and OCR cache that do the actual
+    recognition. A pool can be shared by several OCR instances, e.g. one per
+    device, so tesseract is only started once and the number of sections
+    recognized at once stays bounded across all of them.
+    """
+
+    def __init__(self, engine_name="auto", workers=None, ocr_cache=None):
+        """
+        Args:
+            engine_name (String): one of engine.kEngines
+            workers (Number): of sections recognized at once, default: cores
+            ocr_cache (OCRCache): to reuse text of sections seen before
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        # both engines release the GIL while recognizing, so a thread per
+        # core is enough to keep every core busy during OCR
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers)
+        self.engine = engine.make_engine(engine_name, self.workers)
+        self.logger.info("Using {} OCR engine".format(self.engine.name))
+        self.ocr_cache = ocr_cache
+
+    def warm_up(self):
+        """Starts every worker thread and primes the engine's handles, so the
+        first question doesn't pay for them
+        """
+        # threads are only started when none is idle, so hold each one until
+        # they have all started
+        started = threading.Barrier(self.workers)
+        list(self.executor.map(lambda _: started.wait(), range(self.workers)))
+        self.engine.warm_up()
+
+    def close(self):
+        """Releases the worker threads, engine and cache
+        """
+        self.executor.shutdown()
+        self.engine.close()
+        if self.ocr_cache is not None:
+            self.logger.info("OCR cache: {}".format(self.ocr_cache.stats()))
+            self.ocr_cache.close()
 
 
 class OCR:
@@ -17,57 +73,132 @@ class OCR:
     Cropping boundaries are currently hard-coded for use on an iPhoneX
     """
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, engine_name="auto", frame_source=None,
+                 metrics=None, workers=None, ocr_cache=None, tight_crop=True,
+                 layout_cache=None, pool=None):
+        """
+        Args:
+            pool (OCRPool): to recognize with, shared with other instances.
+                            If None one is made with the engine, workers and
+                            cache given, and closed along with this instance.
+            tight_crop (Bool): to crop each section down to its text and
+                               recognize it with a page segmentation mode
+                               suited to the section
+            layout_cache (String): file of detected answer boxes, if given the
+                                   boxes are detected on the first frame when
+                                   the file doesn't hold them for this config
+        """
         self.image_name = None
+        self.image_data = None
         self.cv_image_data = None
+        self.bounds = []
+        self.metrics = metrics or Metrics()
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info("Loading config file: {}".format(config_file))
-        config_parse = configparser.ConfigParser()
-        config_parse.read(config_file)
-        self.config = dict(config_parse['DEFAULT'])
-        # ensure all values are ints
-        self.config = dict((k, int(v)) for k, v in self.config.items())
+        self.config = layout.load_config(config_file)
+        self.layout = layout.Layout(self.config)
+        self.tight_crop = tight_crop
+        self.layout_cache = layout_cache
+        self.detect_answers = False
+        if layout_cache is not None:
+            if self.layout.load_geometry(layout_cache):
+                self.logger.info("Loaded answer boxes from {}".format(
+                    layout_cache))
+            else:
+                self.detect_answers = True
         # All text boxes have the same left alignment
         self.LEFT_ALIGN = 27
         # All text boxes have the same right alignment
         self.WIDTH = 785 - self.LEFT_ALIGN
         # All answer boxes have the same height
         self.ANSWER_HEIGHT = 120
+        self.owns_pool = pool is None
+        self.pool = pool or OCRPool(engine_name, workers, ocr_cache)
+        self.executor = self.pool.executor
+        self.engine = self.pool.engine
+        self.ocr_cache = self.pool.ocr_cache
+        self.frame_source_spec = frame_source or frames.default_frame_source()
+        self.frame_source = None
 
     def load_image(self, image_name, show=True):
         """Loads the image into memory
         """
         self.image_name = image_name
         self.image_data = Image.open(image_name)
+        self.bounds = []
 
     def draw_bounds(self, x, y, w, h):
-        image_draw = ImageDraw.Draw(self.image_data)
-        image_draw.rectangle([x, y, x + w, y + h], outline="red")
+        """Records a section outline to be drawn on the annotated image.
+        Outlines are never drawn into image_data itself, since other sections
+        may still be cropped from it.
+        """
+        self.bounds.append((x, y, w, h))
+
+    def annotated_image(self):
+        """Returns a copy of the image data with all section outlines drawn
+        """
+        return annotate(self.image_data, self.bounds)
 
     def capture_screen(self, show=False):
-        """Capture screen and save image as a PIL.Image
+        """Capture a frame from the frame source and store it as a PIL.Image
+
+        Returns:
+            (Bool): False if the frame source has no more frames
         """
-        self.logger.info("Grabbing screen data")
-        # use Applescript to find the windowid param to pass to screencapture
-        # TODO(curtismuntz): Figure out similar tool for Ubuntu/android
-        os.system(
-            "screencapture -l$(osascript -e 'tell app \"QuickTime Player\" to id of window 1') tmp.png")
-        self.image_data = Image.open("tmp.png")
+        image_data = self.grab_frame()
+        if image_data is None:
+            return False
+        self.image_data = image_data
+        self.image_name = None
+        self.bounds = []
         if show:
             self.image_data.show()
+        return True
+
+    def grab_frame(self, record=None):
+        """Grabs a frame from the frame source without storing it
+
+        Args:
+            record (Dict): to also add the capture time to, in ms
+        Returns:
+            PIL.Image of the frame, or None if the source has no more frames
+        """
+        self.logger.info("Grabbing screen data")
+        self.open_frame_source()
+        with self.metrics.stage("capture", record):
+            image_data = self.frame_source.grab()
+        if image_data is None:
+            self.logger.info("Frame source exhausted")
+        return image_data
+
+    def open_frame_source(self):
+        """Creates the frame source, if it wasn't already
+        """
+        if self.frame_source is None:
+            self.frame_source = frames.make_frame_source(
+                self.frame_source_spec, self.config['capture_width'],
+                self.config['capture_height'])
+        return self.frame_source
+
+    def warm_up(self):
+        """Loads what cropping needs ahead of the first frame, and warms up
+        the pool unless it's shared
+        """
+        if self.tight_crop or self.detect_answers:
+            import detect
+            # the first OpenCV call sets up its thread pool
+            detect.tight_crop(np.full((32, 32), 255, np.uint8))
+        if self.owns_pool:
+            self.pool.warm_up()
 
     def split_image(self, show=False):
-        """Parses the image into four chunks.
-        1: Question section
-        2: Answer A
-        3: Answer B
-        4: Answer C
-        """
-        question = self.get_question(show)
-        answer_a = self.get_answer_A(show)
-        answer_b = self.get_answer_B(show)
-        answer_c = self.get_answer_C(show)
-        return question, answer_a, answer_b, answer_c
+        """Parses the image into the question and each answer section
+
+        Returns:
+            (Tuple): of the question string and a list of answer strings
+        """
+        question, *answers = self.ocr_regions(show)
+        return question, answers
 
     def image(self):
         """Returns the image data
@@ -79,81 +210,114 @@ class OCR:
         """
         return self.image_name
 
+    def question_image(self, image=None):
+        """Returns the question section of a frame (default: the image data),
+        without running OCR
+        """
+        if image is None:
+            image = self.image_data
+        r = self.layout.question
+        return image.crop((r.x, r.y, r.x + r.w, r.y + r.h))
+
+    def ocr_regions(self, show=False):
+        """Runs OCR on the question and all answer sections concurrently.
+        Every section is cropped before any bounds are drawn, so the outlines
+        never leak into a neighbouring section.
+
+        Returns:
+            (List): of strings, the question followed by each answer
+        """
+        results = self.ocr_frame(self.image_data)
+        for r in self.layout.regions:
+            self.draw_bounds(r.x, r.y, r.w, r.h)
+        return results
+
+    def ocr_frame(self, image, record=None):
+        """Runs OCR on the question and all answer sections of a frame
+        concurrently. Unlike ocr_regions the frame is passed in rather than
+        read from the image data, so frames can be grabbed and processed on
+        different threads.
+
+        Args:
+            image: PIL.Image of the frame
+            record (Dict): to also add the OCR times to, in ms
+        Returns:
+            (List): of strings, the question followed by each answer
+        """
+        self.logger.info("Processing question and answers")
+        if self.detect_answers:
+            self.find_answer_boxes(image)
+        regions = self.layout.regions
+        with self.metrics.stage("ocr", record):
+            with self.metrics.stage("binarize", record):
+                sections = layout.binarize_regions(image, regions)
+            return list(self.executor.map(
+                self.timed_ocr_section, sections,
+                ["ocr_" + r.name for r in regions],
+                [self.region_psm(r) for r in regions],
+                [record] * len(regions)))
+
+    def region_psm(self, region):
+        """Returns the page segmentation mode to recognize a region with
+        """
+        if not self.tight_crop:
+            return None
+        if region.name == self.layout.question.name:
+            return kQuestionPSM
+        return kAnswerPSM
+
+    def find_answer_boxes(self, image):
+        """Detects the answer boxes of a frame, replacing the configured
+        answer regions and saving them to the layout cache once found
+        """
+        import detect
+        question = self.layout.question
+        with self.metrics.stage("detect_answers"):
+            boxes = detect.find_answer_boxes(
+                image, question.y + question.h, self.layout.num_answers)
+        if boxes is None:
+            self.logger.info("Answer boxes not found, using the config")
+            return
+        self.layout.set_answers(boxes)
+        self.layout.save_geometry(self.layout_cache)
+        self.detect_answers = False
+        self.logger.info("Detected answer boxes {}, saved to {}".format(
+            boxes, self.layout_cache))
+
     def get_question(self, show=False):
         """Returns the detected text within the question section of the image
         """
         self.logger.info("Processing question")
-        x = self.config['horizontal_padding'] + \
-            self.config['question_left_margin']
-        y = self.config['question_top_margin'] + \
-            self.config['vertical_padding']  # 270
-        w = self.config['capture_width'] - self.config['horizontal_padding'] - \
-            self.config['question_right_margin'] - \
-            self.config['question_left_margin'] - \
-            self.config['horizontal_padding']
-        h = self.config['question_height']
-        self.draw_bounds(x, y, w, h)
-        result = self.run_ocr_on_image_section(x, y, w, h, show)
-        return result
+        return self.get_section(self.layout.question, show)
 
-    def get_answer_A(self, show=False):
-        """Returns the detected text within the first answer section of the image
-        """
-        self.logger.info("Processing answer 1")
-        x = self.config['horizontal_padding'] + \
-            self.config['answer_left_margin']
-        y = self.config['vertical_padding'] + self.config['question_top_margin'] + \
-            self.config['question_height'] + \
-            self.config['answer_first_top_margin']
-        w = self.config['capture_width'] - self.config['horizontal_padding'] - \
-            self.config['answer_right_margin'] - \
-            self.config['answer_left_margin'] - \
-            self.config['horizontal_padding']
-        h = self.config['answer_height']
-        self.draw_bounds(x, y, w, h)
-        result = self.run_ocr_on_image_section(x, y, w, h, show)
-        return result
+    def get_answer(self, index, show=False):
+        """Returns the detected text within an answer section of the image
 
-    def get_answer_B(self, show=False):
-        """Returns the detected text within the second answer section of the image
-        """
-        self.logger.info("Processing answer 2")
-        x = self.config['horizontal_padding'] + \
-            self.config['answer_left_margin']
-        y = self.config['vertical_padding'] + self.config['question_top_margin'] + \
-            self.config['question_height'] + \
-            self.config['answer_first_top_margin'] + \
-            1 * self.config['answer_height']
-        w = self.config['capture_width'] - self.config['horizontal_padding'] - \
-            self.config['answer_right_margin'] - \
-            self.config['answer_left_margin'] - \
-            self.config['horizontal_padding']
-        h = self.config['answer_height']
-        self.draw_bounds(x, y, w, h)
-        result = self.run_ocr_on_image_section(x, y, w, h, show)
-        return result
+        Args:
+            index: zero based index of the answer, from the top of the screen
+        """
+        self.logger.info("Processing answer {}".format(index + 1))
+        return self.get_section(self.layout.answer(index), show)
 
-    def get_answer_C(self, show=False):
-        """Returns the detected text within the third answer section of the image
-        """
-        self.logger.info("Processing answer 3")
-        x = self.config['horizontal_padding'] + \
-            self.config['answer_left_margin']
-        y = self.config['vertical_padding'] + self.config['question_top_margin'] + \
-            self.config['question_height'] + \
-            self.config['answer_first_top_margin'] + \
-            2 * self.config['answer_height']
-        w = self.config['capture_width'] - self.config['horizontal_padding'] - \
-            self.config['answer_right_margin'] - \
-            self.config['answer_left_margin'] - \
-            self.config['horizontal_padding']
-        h = self.config['answer_height']
-        self.draw_bounds(x, y, w, h)
-        result = self.run_ocr_on_image_section(x, y, w, h, show)
+    def get_section(self, region, show=False):
+        """Runs OCR on a single region and records its bounds for drawing
+        """
+        result = self.ocr_section(
+            self.prepare_section(region.x, region.y, region.w, region.h),
+            self.region_psm(region))
+        self.draw_bounds(region.x, region.y, region.w, region.h)
         return result
 
+    def close(self):
+        """Releases the frame source, and the OCR pool unless it was shared
+        """
+        if self.owns_pool:
+            self.pool.close()
+        if self.frame_source is not None:
+            self.frame_source.close()
+
     def save_image(self, save_filename):
-        self.image_data.save(save_filename + ".png")
+        self.annotated_image().save(save_filename + ".png")
         self.logger.info("Saved capture as {}".format(save_filename + ".png"))
 
     def crop(self, image, x, y, w, h, show=False):
@@ -179,6 +343,7 @@ class OCR:
             description: string to title the display window
             image: opencv image to display
         """
+        import cv2
         cv2.namedWindow(description, cv2.WINDOW_NORMAL)
         cv2.resizeWindow(description, 600, 600)
         cv2.imshow(description, image)
@@ -187,13 +352,43 @@ class OCR:
     def run_ocr_on_image_section(self, x, y, w, h, show=False):
         """Runs OCR on a section of image and returns the string detected
         """
-        cropped = self.image_data.crop((x, y, x + w, y + h))
-        gray = cropped.convert('L')
-        img = gray.point(lambda x: 0 if x < 200 else 255, '1')
-        # if show:
-        #     img.show()
-        ret_string = pytesseract.image_to_string(img)
+        return self.ocr_section(self.prepare_section(x, y, w, h))
+
+    def prepare_section(self, x, y, w, h):
+        """Crops and thresholds a section of image ready for OCR
+        """
+        region = layout.Region("section", x, y, w, h)
+        return layout.binarize_regions(self.image_data, [region])[0]
+
+    def timed_ocr_section(self, img, stage, psm=None, record=None):
+        """Runs ocr_section, timing it as the given stage
+        """
+        with self.metrics.stage(stage, record):
+            return self.ocr_section(img, psm, record)
+
+    def ocr_section(self, img, psm=None, record=None):
+        """Returns the string detected in a prepared section of image
+
+        Args:
+            img: binarized section from prepare_section
+            psm (Number): tesseract page segmentation mode, default: auto
+            record (Dict): to also add the crop time to, in ms
+        """
+        if self.tight_crop:
+            import detect
+            with self.metrics.stage("crop", record):
+                img = detect.tight_crop(img)
+            if img is None:
+                # nothing but blank space, no need to ask tesseract
+                return ""
+        if self.ocr_cache is not None:
+            key, cached = self.ocr_cache.get(img, psm, self.engine.name)
+            if cached is not None:
+                return cached
+        ret_string = self.engine.recognize(img, psm)
         ret_string = ret_string.replace("\n", " ")
+        if self.ocr_cache is not None:
+            self.ocr_cache.put(key, img, ret_string, psm, self.engine.name)
         return ret_string
 
 
@@ -203,6 +398,84 @@ def sanitize_file(file_name):
     return os.path.expanduser(file_name)
 
 
+# OCR instance of a batch worker process, kept warm across images
+worker_ocr = None
+
+
+def init_batch_worker(config_file, engine_name, tight_crop, layout_cache):
+    global worker_ocr
+    # parallelism comes from the process pool, so one thread per worker
+    worker_ocr = OCR(config_file, engine_name, workers=1,
+                     tight_crop=tight_crop, layout_cache=layout_cache)
+
+
+def process_batch_image(image_name):
+    """Runs OCR on one image in a batch worker process
+
+    Returns:
+        (Dict): of the image name with its question and answers, or an error
+    """
+    try:
+        worker_ocr.load_image(image_name)
+        question, answers = worker_ocr.split_image()
+        return {"image": image_name, "question": question, "answers": answers}
+    except Exception as e:
+        return {"image": image_name, "error": str(e)}
+
+
+def list_batch_images(pattern):
+    """Returns the images of a directory, or matching a glob, sorted
+    """
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, "*.png")) +
+                      glob.glob(os.path.join(pattern, "*.jpg")))
+    return sorted(glob.glob(pattern))
+
+
+def completed_batch_images(output_file):
+    """Returns the images already read successfully into a batch output
+    file. Images that failed are left out, so a resumed batch retries them.
+    """
+    completed = set()
+    if output_file and os.path.exists(output_file):
+        with open(output_file) as fp:
+            for line in fp:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # a partial last line from an interrupted run
+                    continue
+                if "image" in result and "error" not in result:
+                    completed.add(result["image"])
+    return completed
+
+
+def run_batch(pattern, config_file, engine_name, output_file=None, jobs=None,
+              tight_crop=True, layout_cache=None):
+    """Runs OCR on every image of a directory or glob on a process pool,
+    writing one JSON line per image as each one completes. Images already in
+    the output file are skipped, so an interrupted batch can be resumed.
+    tight_crop and layout_cache are passed on to each worker's OCR.
+    """
+    logger = logging.getLogger("Batch")
+    completed = completed_batch_images(output_file)
+    pending = [i for i in list_batch_images(pattern) if i not in completed]
+    logger.info("Processing {} images, skipping {} already done".format(
+        len(pending), len(completed)))
+    out = open(output_file, "a") if output_file else sys.stdout
+    try:
+        with multiprocessing.Pool(jobs or os.cpu_count() or 1,
+                                  init_batch_worker,
+                                  (config_file, engine_name, tight_crop,
+                                   layout_cache)) as pool:
+            for result in pool.imap_unordered(process_batch_image, pending):
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+    finally:
+        if output_file:
+            out.close()
+
+
 def main():
     import argparse
     arg_parser = argparse.ArgumentParser(
@@ -212,11 +485,32 @@ def main():
     arg_parser.add_argument("--config_file", "-f",
                             help="The phone config file (default: iphone_x_macpro_2880x1800)",
                             default="configs/iphone_x_macpro_2880x1800")
+    arg_parser.add_argument("--engine", "-e", choices=engine.kEngines,
+                            help="The OCR engine (default: auto)",
+                            default="auto")
     arg_parser.add_argument("--capture", "-c", action='store_true',
                             help="Capture the screen")
+    arg_parser.add_argument("--source", help="The frame source to capture from: "
+                            "screencapture, replay[:<glob>], "
+                            "x11[:<x>,<y>,<w>,<h>] or "
+                            "video:<file or device>[@<skip>] "
+                            "(default: platform specific)")
     arg_parser.add_argument("--save", "-s", help="Save the image")
     arg_parser.add_argument("--display", "-d", action='store_true',
                             help="Display the image")
+    arg_parser.add_argument("--batch", "-b",
+                            help="Process every image of a directory or glob")
+    arg_parser.add_argument("--jobs", "-j", type=int,
+                            help="Batch worker processes (default: one per core)")
+    arg_parser.add_argument("--output", "-o",
+                            help="Batch output file of JSON lines, resumed if "
+                            "it exists (default: stdout)")
+    arg_parser.add_argument("--no_tight_crop", action='store_true',
+                            help="OCR the configured sections as they are, "
+                            "without cropping to the text")
+    arg_parser.add_argument("--detect_answers",
+                            help="Detect the answer boxes and cache them in "
+                            "this file")
     args = arg_parser.parse_args()
 
     # verify config file exists
@@ -224,7 +518,15 @@ def main():
         print("Must provide valid phone config file (-f)")
         exit(-1)
 
-    ocr = OCR(args.config_file)
+    if args.batch:
+        run_batch(sanitize_file(args.batch), args.config_file, args.engine,
+                  args.output, args.jobs, not args.no_tight_crop,
+                  args.detect_answers)
+        return
+
+    ocr = OCR(args.config_file, args.engine, args.source,
+              tight_crop=not args.no_tight_crop,
+              layout_cache=args.detect_answers)
     if args.input_file:
         input_file = sanitize_file(args.input_file)
         ocr.load_image(input_file, show=True)
@@ -233,13 +535,12 @@ def main():
     if args.save:
         ocr.save_image(args.save)
 
-    question, a_str, b_str, c_str = ocr.split_image(args.display)
-    ocr.image_data.show()
+    question, answers = ocr.split_image(args.display)
+    ocr.annotated_image().show()
 
     print("Question: {}".format(question))
-    print("Option A: {}".format(a_str))
-    print("Option B: {}".format(b_str))
-    print("Option C: {}".format(c_str))
+    for i, answer in enumerate(answers):
+        print("Option {}: {}".format(chr(ord('A') + i), answer))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import collections
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+import cache
+import change
+import engine
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kModes = ["off", "exact", "perceptual"]
+# hash grid of the perceptual mode
+kPerceptualSize = 16
+# max bits of the perceptual hash that may differ for a hit. Crops of "1956"
+# and "1959" are only 6 bits apart, so this only allows for speckle noise.
+kPerceptualDistance = 2
+
+
+def section_key(section, psm=None, engine_name=""):
+    """Hashes the exact pixels of a binarized section, and how it is read
+    """
+    pixels = np.ascontiguousarray(section)
+    digest = hashlib.blake2b(pixels.tobytes(), digest_size=16)
+    digest.update("{}:{}:{}".format(pixels.shape, psm, engine_name).encode(
+        "utf-8"))
+    return digest.hexdigest()
+
+
+class OCRCache:
+    """Caches OCR text by the content of the binarized section it came from,
+    so unchanged sections are never sent to tesseract twice. In perceptual
+    mode a section also hits if it was cropped to the same size, is read the
+    same way, and its difference hash is within a couple of bits of a cached
+    one, which tolerates speckle noise between frames.
+    """
+
+    def __init__(self, path=None, memory_size=512, perceptual=False):
+        """
+        Args:
+            path (String): of the on-disk cache, None to keep memory only
+            memory_size (Number): of sections kept in memory
+            perceptual (Bool): to also match near identical sections
+        """
+        self.exact = cache.TieredCache(path, memory_size)
+        self.perceptual = perceptual
+        self.memory_size = memory_size
+        self.hashes = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+
+    def get(self, section, psm=None, engine_name=""):
+        """Looks a section up
+
+        Args:
+            section: binarized section
+            psm (Number): page segmentation mode it is read with
+            engine_name (String): of the engine that reads it
+        Returns:
+            (Tuple): of the section's key and its cached text, None on a miss
+        """
+        key = section_key(section, psm, engine_name)
+        text = self.exact.get(key)
+        if text is not None:
+            with self.lock:
+                self.hits += 1
+            return key, text
+        if self.perceptual:
+            section_hash = change.dhash(engine.to_pil(section),
+                                        kPerceptualSize)
+            context = (section.shape, psm, engine_name)
+            with self.lock:
+                for cached_hash, (cached_context, cached_text) in \
+                        self.hashes.items():
+                    if cached_context == context and \
+                            change.hamming(section_hash, cached_hash) <= \
+                            kPerceptualDistance:
+                        self.perceptual_hits += 1
+                        return key, cached_text
+        with self.lock:
+            self.misses += 1
+        return key, None
+
+    def put(self, key, section, text, psm=None, engine_name=""):
+        """Caches the text of a section under the key returned by get
+        """
+        self.exact.put(key, text)
+        if self.perceptual:
+            section_hash = change.dhash(engine.to_pil(section),
+                                        kPerceptualSize)
+            with self.lock:
+                self.hashes[section_hash] = (
+                    (section.shape, psm, engine_name), text)
+                while len(self.hashes) > self.memory_size:
+                    self.hashes.popitem(last=False)
+
+    def stats(self):
+        """Returns a summary string of the cache hit rate
+        """
+        with self.lock:
+            hits = self.hits + self.perceptual_hits
+            perceptual_hits = self.perceptual_hits
+            misses = self.misses
+        total = hits + misses
+        rate = 100.0 * hits / total if total else 0.0
+        return "{} hits ({} perceptual), {} misses, {:.1f}% hit rate".format(
+            hits, perceptual_hits, misses, rate)
+
+    def close(self):
+        self.exact.close()
+
+
+def make_ocr_cache(mode, path=None):
+    """Creates an OCR cache for a mode of kModes, None for off
+    """
+    if mode not in kModes:
+        raise ValueError("Unknown OCR cache mode {}, expected one of {}".format(
+            mode, kModes))
+    if mode == "off":
+        return None
+    return OCRCache(path, perceptual=mode == "perceptual")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import codecs
+import concurrent.futures
+import html.parser
+import logging
+import time
+
+import requests
+from requests import adapters
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kMaxConcurrentPages = 8
+# bytes of a page read at most, the rest of a long page is dropped
+kMaxPageBytes = 512 * 1024
+# seconds to connect, and to wait for each chunk of a page
+kConnectTimeout = 1.0
+kReadTimeout = 2.0
+kChunkSize = 16 * 1024
+kSkippedTags = ["script", "style", "noscript", "template", "svg"]
+kUserAgent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_1) " \
+    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/62.0.3202.94 Safari/537.36"
+
+
+class TextExtractor(html.parser.HTMLParser):
+    """Collects the visible text of an HTML document as it is fed in chunks
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in kSkippedTags:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in kSkippedTags and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+    def text(self):
+        return " ".join(" ".join(self.parts).split())
+
+
+class PageFetcher:
+    """Fetches the text of result pages concurrently over one pooled
+    keep-alive session. Every page is streamed and parsed as it arrives,
+    and reading stops at a size cap or the deadline, whichever comes first.
+    """
+
+    def __init__(self, workers=kMaxConcurrentPages, max_bytes=kMaxPageBytes):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        adapter = adapters.HTTPAdapter(pool_connections=workers,
+                                       pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = kUserAgent
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+
+    def fetch_text(self, url, deadline=None):
+        """Returns the visible text of a page
+
+        Args:
+            url (String): of the page
+            deadline (Number): time.time() to stop reading at, if any
+        Returns:
+            (String): the text, empty if the page isn't text or HTML
+        """
+        with self.session.get(url, stream=True,
+                              timeout=(kConnectTimeout, kReadTimeout)) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "text/html")
+            if not content_type.startswith("text/"):
+                return ""
+            encoding = "utf-8"
+            if "charset" in content_type:
+                encoding = response.encoding
+            decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+            extractor = TextExtractor()
+            feed = extractor.feed
+            if content_type.startswith("text/plain"):
+                # plain text is kept as it is, markup or not
+                feed = extractor.handle_data
+            received = 0
+            for chunk in response.iter_content(kChunkSize):
+                feed(decoder.decode(chunk))
+                received += len(chunk)
+                if received >= self.max_bytes:
+                    break
+                if deadline is not None and time.time() > deadline:
+                    break
+            feed(decoder.decode(b"", final=True))
+            return extractor.text()
+
+    def fetch_all(self, urls, timeout):
+        """Fetches several pages at once, so the wait is that of the slowest
+        page rather than the sum of them all
+
+        Args:
+            urls (List): of pages to fetch
+            timeout (Number): seconds to wait for all the pages
+        Returns:
+            (Dict): of each url fetched in time to its text
+        """
+        deadline = time.time() + timeout
+        futures = dict((self.executor.submit(self.fetch_text, url, deadline),
+                        url) for url in urls)
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        for future in not_done:
+            future.cancel()
+        texts = {}
+        for future in done:
+            try:
+                texts[futures[future]] = future.result()
+            except Exception as e:
+                self.logger.info("Unable to fetch {}: {}".format(
+                    futures[future], e))
+        return texts
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
@@ -1,32 +1,108 @@
 #!/usr/bin/env python3
-import collections
-from fuzzywuzzy import fuzz
-from google import google
+import concurrent.futures
 import logging
 import operator
-import re
-import requests
 import termcolor
+import time
 import webbrowser
 
+import backends
+from metrics import Metrics
+import normalize
+import scoring
+
 logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
 kInversionWords = ["not"]
+kMaxConcurrentRequests = 16
+# seconds to wait for result pages when expanding evidence
+kExpandTimeout = 2.0
 
 
 class WebQuery:
 
-    def __init__(self):
+    def __init__(self, backend=None, cache=None, metrics=None, expand=0,
+                 fetcher=None, expand_timeout=kExpandTimeout,
+                 number_words=False):
+        """
+        Args:
+            backend: to search with, defaults to scraping google
+            cache (TieredCache): for search results, None to disable caching
+            metrics (Metrics): to time searches and scoring with
+            expand (Number): of the top results to score the full page text
+                             of rather than just the description
+            fetcher (PageFetcher): to fetch pages with, made if needed
+            expand_timeout (Number): seconds to wait for the pages
+            number_words (Bool): spell out numbers in answers and results
+                                 when scoring, so "1956" matches "nineteen
+                                 fifty six"
+        """
         self.results = []
+        # normalized descriptions of self.results, made once for all scorers
+        self.corpus_texts = []
+        self.corpus_results = None
+        self.number_words = number_words
+        self.metrics = metrics or Metrics()
+        # the record of the question being answered, to also add the stage
+        # timings to
+        self.record = None
+        # open a browser for the query when no answer is found at all
+        self.open_browser = True
+        self.backend = backend or backends.GoogleBackend()
+        self.cache = cache
         self.logger = logging.getLogger(self.__class__.__name__)
         self.inversion = False
+        self.answer_results = {}
+        self.completed = 0
+        self.submitted = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=kMaxConcurrentRequests)
+        self.expand = expand
+        self.expand_timeout = expand_timeout
+        self.fetcher = fetcher
+        if expand and fetcher is None:
+            # imported here, requests is only needed to expand results
+            import pages
+            self.fetcher = pages.PageFetcher()
 
-    def search_google(self, query, pages=3, print_results=False):
-        """Query google for search results
+    def warm_up(self):
+        """Primes the search backend and the scorers, without searching or
+        touching the cache
+        """
+        self.backend.warm_up()
+        scoring.fuzzy_matrix(["warm up"], ["warm up"])
+        scoring.AnswerMatcher([("warm up", ["warm up"])]).count("warm up")
+        normalize.numbers_to_words(normalize.normalize("warm up 1"))
+
+    def corpus(self):
+        """Returns the normalized description of every result. Each
+        description is normalized once, however many scorers read it and as
+        results stream in, until self.results is replaced.
+        """
+        if self.corpus_results is not self.results:
+            self.corpus_results = self.results
+            self.corpus_texts = []
+        if len(self.corpus_texts) < len(self.results):
+            with self.metrics.stage("normalize", self.record):
+                for result in self.results[len(self.corpus_texts):]:
+                    text = normalize.normalize(result.description)
+                    if self.number_words:
+                        text = normalize.numbers_to_words(text)
+                    self.corpus_texts.append(text)
+        return self.corpus_texts
+
+    def scored_answers(self, answers):
+        """Returns the answers as they are matched against the corpus
+        """
+        if self.number_words:
+            return [normalize.numbers_to_words(a) for a in answers]
+        return answers
+
+    def prepare_query(self, query):
+        """Marks and strips inversion language from the query
         Args:
-            query (String): to send to google
-            pages (Number): of pages to parse from google result
+            query (String): as read from the question
         Returns:
-            (Bool): On Success or failure
+            (String): query to send to the backend
         """
         self.query = query
         self.inversion = False
@@ -47,17 +123,278 @@ class WebQuery:
         query_without_inversion_str = " ".join(query_without_inversion)
         self.logger.info("=================================")
         self.logger.info("Query: \"{}\"".format(colored_query_str))
+        return query_without_inversion_str
+
+    def search_google(self, query, pages=3, print_results=False):
+        """Query the search backend (google by default) for search results
+        Args:
+            query (String): to send to the backend
+            pages (Number): of pages to parse from google result
+        Returns:
+            (Bool): On Success or failure
+        """
+        query_without_inversion_str = self.prepare_query(query)
         try:
-            self.results = google.search(query_without_inversion_str, pages)
+            with self.metrics.stage("search", self.record):
+                self.results = self.fetch(query_without_inversion_str, pages)
         except Exception as e:
-            self.logger.error("Caught exception in google query: {}".format(e))
+            self.logger.error("Caught exception in {} query: {}".format(
+                self.backend.name, e))
             return False
-        self.logger.info("Got {} results from the googz".format(
-            len(self.results)))
+        self.logger.info("Got {} results from {}".format(
+            len(self.results), self.backend.name))
+        self.expand_results()
         if print_results:
             print(self.results)
         return True
 
+    def fetch(self, query, pages=1, first_page=0):
+        """Fetches backend results for a query, through the cache if enabled
+        Args:
+            query (String): to send, inversion words already removed
+            pages (Number): of pages to fetch
+            first_page (Number): index of the first page to fetch
+        Returns:
+            (List): of search results
+        """
+        with self.metrics.stage("fetch", self.record):
+            return self.cached_search(query, pages, first_page)
+
+    def cached_search(self, query, pages, first_page):
+        if self.cache is None:
+            return self.backend.search(query, pages, first_page)
+        key = "{}:{}:{}:{}".format(self.backend.name, pages, first_page,
+                                   backends.normalize_query(query))
+        packed = self.cache.get(key)
+        if packed is None:
+            packed = backends.pack_results(
+                self.backend.search(query, pages, first_page))
+            # no results is usually google throttling us, so it isn't kept
+            # for the cache's ttl, the next search goes out again
+            if packed:
+                self.cache.put(key, packed)
+        self.logger.debug("Search cache: {}".format(self.cache.stats()))
+        return backends.unpack_results(packed)
+
+    def submit_fanout(self, query_str, answers, pages):
+        """Submits every request of a fan-out search to the request pool
+        Returns:
+            (Dict): of each future to its answer, None for the question query,
+                    in submission order
+        """
+        requests_by_future = {}
+        for page in range(pages):
+            future = self.executor.submit(self.fetch, query_str, 1, page)
+            requests_by_future[future] = None
+        for answer in answers:
+            future = self.executor.submit(
+                self.fetch, "{} {}".format(query_str, answer), 1)
+            requests_by_future[future] = answer
+        return requests_by_future
+
+    def stream_fanout(self, query, answers, pages=3, deadline=5.0):
+        """Runs a fan-out search like search_fanout, yielding each request's
+        results as soon as it completes. Requests not done by the deadline,
+        or when the caller stops iterating, are cancelled.
+        Args:
+            query (String): to send to the backend
+            answers (List): of strings containing each answer
+            pages (Number): of pages to parse for the question query
+            deadline (Number): seconds to wait for all requests
+        Yields:
+            (Tuple): of the answer (None for the question query) and results
+        """
+        query_str = self.prepare_query(query)
+        requests_by_future = self.submit_fanout(query_str, answers, pages)
+        self.results = []
+        self.answer_results = dict((answer, []) for answer in answers)
+        self.completed = 0
+        self.submitted = len(requests_by_future)
+        try:
+            for future in concurrent.futures.as_completed(
+                    requests_by_future, timeout=deadline):
+                answer = requests_by_future[future]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    self.logger.error("Caught exception in {} query: {}".format(
+                        self.backend.name, e))
+                    continue
+                self.completed += 1
+                if answer is None:
+                    self.results.extend(results)
+                else:
+                    self.answer_results[answer].extend(results)
+                yield answer, results
+        except concurrent.futures.TimeoutError:
+            self.logger.info("Out of time, dropping {} queries".format(
+                self.submitted - self.completed))
+        finally:
+            for future in requests_by_future:
+                future.cancel()
+
+    def answer_progressive(self, query, answers, pages=3, deadline=5.0):
+        """Scores answers with fuzzy matching as fan-out results stream in,
+        logging a provisional ranking whenever new evidence arrives: the
+        fuzzy ranking for results of the question query, the answer hits for
+        results of a question and answer query. With expand set, the top
+        pages are fetched in what is left of the deadline and all the
+        results rescored once they're in.
+        Args:
+            query (String): to send to the backend
+            answers (List): of strings containing each answer
+            pages (Number): of pages to parse for the question query
+            deadline (Number): seconds to spend searching
+        Returns:
+            (OrderedDict): Dictionary of results, sorted by most probable
+        """
+        stop_at = time.time() + deadline
+        counts = dict((answer, 0) for answer in answers)
+        scored_answers = self.scored_answers(answers)
+        for answer, results in self.stream_fanout(query, answers, pages,
+                                                  deadline):
+            if answer is not None:
+                self.answer_hits(answers, "Provisional answer hit results "
+                                 "({} for {})".format(len(results), answer))
+                continue
+            if not results:
+                continue
+            # fuzzy scores sum over results, so only the new ones are scored
+            new_texts = self.corpus()[-len(results):]
+            with self.metrics.stage("score_fuzzy", self.record):
+                matrix = scoring.fuzzy_matrix(scored_answers, new_texts)
+            for a, row in zip(answers, matrix):
+                counts[a] = counts[a] + sum(row)
+            self.rank_counts(counts, "Provisional fuzzy match results "
+                             "({} results)".format(len(self.results)))
+        if self.expand and self.results:
+            self.expand_results(max(stop_at - time.time(), 0))
+            # expanded descriptions replace the results, so score them anew
+            with self.metrics.stage("score_fuzzy", self.record):
+                matrix = scoring.fuzzy_matrix(scored_answers, self.corpus())
+            counts = dict((a, sum(row)) for a, row in zip(answers, matrix))
+        counts = self.rank_counts(counts, "Fuzzy match results")
+        self.logger.info("Answered from {} results of {}/{} queries".format(
+            len(self.results), self.completed, self.submitted))
+        self.check_counts_failure(counts)
+        return counts
+
+    def evidence(self):
+        """Describes how much evidence the last progressive answer was based on
+        """
+        return {"results": len(self.results),
+                "queries_completed": self.completed,
+                "queries_submitted": self.submitted}
+
+    def search_fanout(self, query, answers, pages=3, deadline=5.0):
+        """Query the backend for the question, and the question with each answer,
+        fetching every result page concurrently. Requests still in flight when
+        the deadline passes are dropped.
+        Args:
+            query (String): to send to the backend
+            answers (List): of strings containing each answer
+            pages (Number): of pages to parse for the question query
+            deadline (Number): seconds to wait for all requests
+        Returns:
+            (Bool): True if any request completed
+        """
+        query_str = self.prepare_query(query)
+        requests_by_future = self.submit_fanout(query_str, answers, pages)
+        with self.metrics.stage("search", self.record):
+            done, not_done = concurrent.futures.wait(
+                requests_by_future, timeout=deadline)
+        for future in not_done:
+            future.cancel()
+
+        self.results = []
+        self.answer_results = dict((answer, []) for answer in answers)
+        completed = 0
+        # walk in submission order so results stay in page order
+        for future, answer in requests_by_future.items():
+            if future not in done:
+                continue
+            try:
+                results = future.result()
+            except Exception as e:
+                self.logger.error("Caught exception in {} query: {}".format(
+                    self.backend.name, e))
+                continue
+            completed += 1
+            if answer is None:
+                self.results.extend(results)
+            else:
+                self.answer_results[answer].extend(results)
+        self.logger.info("Got {} results from {}/{} queries to {}".format(
+            len(self.results), completed, len(requests_by_future),
+            self.backend.name))
+        self.expand_results()
+        return completed > 0
+
+    def expand_results(self, timeout=None):
+        """Adds the text of the top result pages to their descriptions, so
+        the scorers see more than a snippet. Pages are fetched concurrently
+        and any not fetched within expand_timeout are left as snippets.
+
+        Args:
+            timeout (Number): seconds to wait for the pages if less than
+                              expand_timeout
+        """
+        if not self.expand:
+            return
+        urls = []
+        for result in self.results:
+            if len(urls) >= self.expand:
+                break
+            if result.link and result.link.startswith("http") and \
+                    result.link not in urls:
+                urls.append(result.link)
+        if timeout is None or timeout > self.expand_timeout:
+            timeout = self.expand_timeout
+        with self.metrics.stage("expand", self.record):
+            texts = self.page_texts(urls, timeout)
+        self.results = [backends.SearchResult(
+            r.name, r.link, "{} {}".format(r.description, texts[r.link]),
+            getattr(r, "number_of_results", None))
+            if texts.get(r.link) else r for r in self.results]
+        self.logger.info("Expanded {} of {} result pages".format(
+            sum(1 for text in texts.values() if text), len(urls)))
+
+    def page_texts(self, urls, timeout):
+        """Returns the text of each page fetched within timeout seconds,
+        through the cache if enabled
+        """
+        texts = {}
+        if self.cache is not None:
+            for url in urls:
+                text = self.cache.get("page:{}".format(url))
+                if text is not None:
+                    texts[url] = text
+        fetched = self.fetcher.fetch_all(
+            [url for url in urls if url not in texts], timeout)
+        if self.cache is not None:
+            for url, text in fetched.items():
+                self.cache.put("page:{}".format(url), text)
+        texts.update(fetched)
+        return texts
+
+    def answer_hits(self, answers, title="Answer hit results"):
+        """Number of search hits for the question combined with each answer,
+        as collected by search_fanout
+        Args:
+            answers (List): of strings containing each answer
+            title (String): to log above the counts
+        Returns:
+            (OrderedDict): Dictionary of results, sorted by most probable
+        """
+        counts = {}
+        for answer in answers:
+            results = self.answer_results.get(answer, [])
+            hits = len(results)
+            if results and getattr(results[0], "number_of_results", None):
+                hits = results[0].number_of_results
+            counts[answer] = hits
+        return self.rank_counts(counts, title)
+
     # def search_bing(self, query):
     #     url = 'https://api.cognitive.microsoft.com/bing/v7.0/composite'
     #     # query string parameters
@@ -101,47 +438,27 @@ class WebQuery:
             if c[1] != 0:
                 all_zeros = False
                 break
-        if all_zeros:
+        if all_zeros and self.open_browser:
             self.logger.info("Found all zeros, spawning chrome")
             query_split = self.query.split()
             query_pluses = "+".join(query_split)
             webbrowser.open(
                 "https://www.google.com/search?q={}".format(query_pluses))
 
-    def answer_frequency(self, answers):
-        """Test frequency of occurance of each answer against the search results
+    def rank_counts(self, counts, title):
+        """Sorts and logs the counts of each answer
         Args:
-            answers (List): of strings containing each answer
+            counts (Dict): of each answer to its score
+            title (String): to log above the counts
         Returns:
-            (OrderedDict): Dictionary of results, sorted by most probable
+            (List): of (answer, count) pairs, sorted by most probable
         """
-        # stage our output counts with the origin answer counts
-        counts = {}
-        for answer in answers:
-            counts[answer] = 0
-
-        # iterate through each answer and count the occurances in each result
-        # description test
-        for answer in answers:
-            # Find additonal answers to search by reversing the order of the
-            # words if there are multiple words
-            answer_perms = self.get_answer_permutations(answer)
-            # find frequency of each answer set (including any possible
-            # reversed strings)
-            for result in self.results:
-                r = re.compile("|".join(r"\b%s\b" % w for w in answer_perms))
-                count_result = collections.Counter(
-                    re.findall(r, result.description.lower()))
-                # update the running counts
-                for _, value in count_result.items():
-                    counts[answer] = counts[answer] + value
-
         # sort the results depending on if an inversion is detected or not
         reverse = False if self.inversion else True
         counts = sorted(counts.items(), key=operator.itemgetter(1),
                         reverse=reverse)
         self.logger.info("=================================")
-        self.logger.info("Permutation match results")
+        self.logger.info(title)
         for i, c in enumerate(counts):
             if i == 0:
                 self.logger.info(termcolor.colored(
@@ -150,7 +467,28 @@ class WebQuery:
                 self.logger.info(termcolor.colored(
                     "{} : {}".format(c[0], c[1]), "red"))
         self.logger.info("=================================")
+        return counts
 
+    def answer_frequency(self, answers):
+        """Test frequency of occurance of each answer against the search results
+        Args:
+            answers (List): of strings containing each answer
+        Returns:
+            (OrderedDict): Dictionary of results, sorted by most probable
+        """
+        # Find additonal answers to search by reversing the order of the
+        # words if there are multiple words, then count the occurances of
+        # each answer set (including any possible reversed strings) in one
+        # pass over all the result descriptions
+        corpus = self.corpus()
+        with self.metrics.stage("score", self.record):
+            matcher = scoring.AnswerMatcher(
+                [(answer, self.get_answer_permutations(scored))
+                 for answer, scored in zip(answers,
+                                           self.scored_answers(answers))])
+            counts = matcher.count(scoring.corpus_text(corpus))
+
+        counts = self.rank_counts(counts, "Permutation match results")
         self.check_counts_failure(counts)
         return counts
 
@@ -161,34 +499,16 @@ class WebQuery:
         Returns:
             (OrderedDict): Dictionary of results, sorted by most probable
         """
-        # stage our output counts with the origin answer counts
+        # score every answer against every result description in one batch
+        # and sum the scores of each answer
+        corpus = self.corpus()
+        with self.metrics.stage("score_fuzzy", self.record):
+            matrix = scoring.fuzzy_matrix(self.scored_answers(answers), corpus)
         counts = {}
-        for answer in answers:
-            counts[answer] = 0
-
-        # iterate through each answer and count the occurances in each result
-        # description test
-        for answer in answers:
-            # find frequency of each answer set using fuzzy techniques
-            for result in self.results:
-                val = fuzz.token_set_ratio(answer, result.description.lower())
-                counts[answer] = counts[answer] + val
-
-        # sort the results depending on if an inversion is detected or not
-        reverse = False if self.inversion else True
-        counts = sorted(counts.items(), key=operator.itemgetter(1),
-                        reverse=reverse)
-        self.logger.info("=================================")
-        self.logger.info("Fuzzy match results")
-        for i, c in enumerate(counts):
-            if i == 0:
-                self.logger.info(termcolor.colored(
-                    "{} : {} <---------------".format(c[0], c[1]), "green"))
-            else:
-                self.logger.info(termcolor.colored(
-                    "{} : {}".format(c[0], c[1]), "red"))
-        self.logger.info("=================================")
+        for answer, row in zip(answers, matrix):
+            counts[answer] = sum(row)
 
+        counts = self.rank_counts(counts, "Fuzzy match results")
         self.check_counts_failure(counts)
         return counts
 
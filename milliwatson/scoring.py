@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import logging
+import re
+
+from fuzzywuzzy import utils
+
+try:
+    from rapidfuzz import fuzz as rapid_fuzz
+    from rapidfuzz import process as rapid_process
+except ImportError:
+    rapid_process = None
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kWordPattern = re.compile(r"\w")
+# answer x result pairs above which fuzzy scoring is spread over all cores
+kParallelPairs = 2000
+
+
+def corpus_text(texts):
+    """Joins the normalized description of every result into one string.
+    Descriptions are separated by a newline, which no answer can contain, so
+    matches never span two results.
+    """
+    return "\n".join(texts)
+
+
+def is_boundary(text, i):
+    """Returns True if a regex word boundary falls before text[i]
+    """
+    before = i > 0 and kWordPattern.match(text[i - 1]) is not None
+    after = i < len(text) and kWordPattern.match(text[i]) is not None
+    return before != after
+
+
+class AnswerMatcher:
+    """Counts every answer and its permutations in a single scan of a corpus.
+    The count for each answer is the same as a findall of
+    \\b<perm 1>\\b|\\b<perm 2>\\b|... over the corpus, as answer_frequency used
+    to run once per answer and result.
+
+    All permutations are compiled into one lookahead pattern, longest first,
+    so the scan reports the longest permutation starting at each position.
+    Any shorter permutation that also matches there is a prefix of it, so
+    which ones match is worked out once here rather than rescanning.
+    """
+
+    def __init__(self, answer_perms):
+        """
+        Args:
+            answer_perms (List): of (answer, list of permutation strings)
+        """
+        self.answer_perms = answer_perms
+        perms = set(p for _, ps in answer_perms for p in ps if p)
+        self.pattern = None
+        if perms:
+            ordered = sorted(perms, key=len, reverse=True)
+            self.pattern = re.compile(r"(?=\b({})\b)".format(
+                "|".join(re.escape(p) for p in ordered)))
+        self.implied = {}
+        for p in perms:
+            self.implied[p] = set(
+                q for q in perms
+                if p.startswith(q) and (q == p or is_boundary(p, len(q))))
+
+    def count(self, text):
+        """Counts the non-overlapping matches of each answer within a corpus
+
+        Returns:
+            (Dict): of each answer to its number of matches
+        """
+        matches = []
+        if self.pattern is not None:
+            matches = [(m.start(), self.implied[m.group(1)])
+                       for m in self.pattern.finditer(text)]
+        counts = {}
+        for answer, perms in self.answer_perms:
+            count = 0
+            next_start = 0
+            for start, matched in matches:
+                if start < next_start:
+                    continue
+                # alternation takes the first permutation that matches
+                for p in perms:
+                    if p and p in matched:
+                        count += 1
+                        next_start = start + len(p)
+                        break
+            counts[answer] = count
+        return counts
+
+
+def fuzzy_matrix(answers, descriptions):
+    """Scores every answer against every description with token_set_ratio.
+    Each string is processed (non-ascii dropped, punctuation stripped) exactly
+    once up front, as token_set_ratio's defaults would. When rapidfuzz is
+    installed the whole matrix is computed in C, on all cores for large
+    corpora, otherwise fuzzywuzzy scores the processed pairs one by one.
+    Both score as fuzzywuzzy does with python-Levenshtein installed.
+
+    Args:
+        answers (List): of answer strings
+        descriptions (List): of normalized result description strings
+    Returns:
+        (List): of rows of int scores (0-100), one row per answer
+    """
+    processed_answers = [utils.full_process(a, force_ascii=True)
+                         for a in answers]
+    processed = [utils.full_process(d, force_ascii=True)
+                 for d in descriptions]
+    if rapid_process is not None:
+        workers = 1
+        if len(answers) * len(descriptions) >= kParallelPairs:
+            workers = -1
+        matrix = rapid_process.cdist(
+            processed_answers, processed, scorer=rapid_fuzz.token_set_ratio,
+            processor=None, workers=workers)
+        # fuzzywuzzy rounds each score to the nearest int
+        return [[int(round(float(v))) for v in row] for row in matrix]
+    # imported here, as it's only the fallback
+    from fuzzywuzzy import fuzz
+    return [[fuzz.token_set_ratio(a, d, full_process=False) for d in processed]
+            for a in processed_answers]
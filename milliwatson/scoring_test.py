@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import random
+import re
+import unittest
+
+from fuzzywuzzy import fuzz
+
+import scoring
+
+
+def permutations(answer):
+    """The permutations WebQuery.get_answer_permutations makes of an answer
+    """
+    words = answer.split()
+    if len(words) > 1:
+        return [answer, " ".join(reversed(words))]
+    return [answer]
+
+
+def regex_counts(answers, descriptions):
+    """Counts each answer as answer_frequency did before AnswerMatcher, with
+    one regex per answer run over every description
+    """
+    counts = {}
+    for answer in answers:
+        pattern = re.compile("|".join(r"\b{}\b".format(re.escape(p))
+                                      for p in permutations(answer)))
+        counts[answer] = sum(len(pattern.findall(d)) for d in descriptions)
+    return counts
+
+
+def matcher_counts(answers, descriptions):
+    matcher = scoring.AnswerMatcher([(a, permutations(a)) for a in answers])
+    return matcher.count(scoring.corpus_text(descriptions))
+
+
+class AnswerMatcherTest(unittest.TestCase):
+
+    def assertSameCounts(self, answers, descriptions):
+        self.assertEqual(matcher_counts(answers, descriptions),
+                         regex_counts(answers, descriptions))
+
+    def test_single_words(self):
+        self.assertSameCounts(
+            ["violins", "spotify", "hearing aids"],
+            ["stradivarius made violins, violins and cellos",
+             "spotify streams music", "no answer here"])
+
+    def test_overlapping_answers(self):
+        # one answer inside another, and an answer that is a prefix of one
+        self.assertSameCounts(
+            ["new york", "new york giants", "york", "giants"],
+            ["the new york giants moved from new york",
+             "york, new york giants giants", "new yorker york"])
+
+    def test_reversed_multi_word_answers(self):
+        self.assertSameCounts(
+            ["louis st", "st louis browns", "browns"],
+            ["st louis browns or the browns of louis st",
+             "louis st louis st louis browns"])
+
+    def test_repeats_and_word_boundaries(self):
+        self.assertSameCounts(
+            ["aa", "aa aa", "a"],
+            ["aa aa aa aaa a aa-aa", "a a a aa"])
+
+    def test_matches_never_span_descriptions(self):
+        self.assertSameCounts(["new york"], ["new", "york new", "york"])
+
+    def test_no_answers(self):
+        self.assertEqual(matcher_counts([], ["anything"]), {})
+        self.assertSameCounts(["something"], [])
+
+    def test_random_corpora(self):
+        rng = random.Random(0)
+        vocabulary = ["new", "york", "giants", "st", "louis", "a", "aa"]
+        for _ in range(300):
+            answers = list(set(
+                " ".join(rng.choice(vocabulary)
+                         for _ in range(rng.randint(1, 3)))
+                for _ in range(rng.randint(1, 4))))
+            descriptions = [
+                rng.choice([" ", ", ", "-"]).join(
+                    rng.choice(vocabulary) for _ in range(rng.randint(0, 12)))
+                for _ in range(rng.randint(1, 4))]
+            self.assertSameCounts(answers, descriptions)
+
+
+class FuzzyMatrixTest(unittest.TestCase):
+
+    def assertSameScores(self, answers, descriptions):
+        # as answer_frequency_fuzzy scored each pair before fuzzy_matrix
+        expected = [[fuzz.token_set_ratio(a, d.lower()) for d in descriptions]
+                    for a in answers]
+        self.assertEqual(scoring.fuzzy_matrix(answers, descriptions), expected)
+
+    def test_plain_text(self):
+        self.assertSameScores(
+            ["violins", "spotify", "hearing aids"],
+            ["Stradivarius made violins, violas and cellos",
+             "Spotify streams music", "", "hearing-aid makers"])
+
+    def test_non_ascii(self):
+        self.assertSameScores(
+            ["100 degrees", "caf\u00e9", "\u00fcber"],
+            ["water boils at 100\u00b0C, about 212\u00b0F",
+             "the caf\u00e9 on the corner", "\u00fcber alles",
+             "\u2014\u2014"])
+
+    def test_random_pairs(self):
+        rng = random.Random(0)
+        vocabulary = ["new", "york", "giants", "st.", "louis", "browns",
+                      "caf\u00e9", "100\u00b0", "it's", "a", "the"]
+        answers = [" ".join(rng.choice(vocabulary)
+                            for _ in range(rng.randint(1, 3)))
+                   for _ in range(20)]
+        descriptions = [" ".join(rng.choice(vocabulary)
+                                 for _ in range(rng.randint(0, 15)))
+                        for _ in range(15)]
+        self.assertSameScores(answers, descriptions)
+
+    def test_parallel_matrix(self):
+        rng = random.Random(1)
+        words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta"]
+        answers = [" ".join(rng.sample(words, 2)) for _ in range(50)]
+        descriptions = [" ".join(rng.choice(words) for _ in range(8))
+                        for _ in range(scoring.kParallelPairs // 50)]
+        self.assertSameScores(answers, descriptions)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import http.server
+import json
+import logging
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import backends
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kDefaultPort = 8080
+# connections waiting to be accepted, enough for a load test's burst
+kRequestQueueSize = 128
+
+
+class NetworkModel:
+    """Delays and fails responses like a real search service would: each
+    response waits latency plus gaussian jitter, and a fraction of them fail
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        """
+        Args:
+            latency (Number): mean seconds before responding
+            jitter (Number): standard deviation of the delay, in seconds
+            error_rate (Number): fraction (0-1) of searches answered with a 503
+            seed (Number): for the random delays and errors, None to vary
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        """Returns the seconds to delay a response by and whether it fails
+        """
+        with self.lock:
+            delay = max(0.0, self.random.gauss(self.latency, self.jitter))
+            failed = self.random.random() < self.error_rate
+        return delay, failed
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    """Serves recorded searches:
+        GET /search?q=<query>&pages=<n>&first_page=<n>  {"results": [...]}
+        GET /health                                     {"searches": <n>}
+    """
+    # keep-alive, so clients reuse their connections as they would google's
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, which Nagle's algorithm
+    # would hold back for the client's delayed ack
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == "/health":
+            self.respond(200, {"searches": len(self.server.backend.recordings)})
+            return
+        if url.path != "/search":
+            self.respond(404, {"error": "not found"})
+            return
+        params = urllib.parse.parse_qs(url.query)
+        try:
+            query = params["q"][0]
+            pages = int(params.get("pages", ["1"])[0])
+            first_page = int(params.get("first_page", ["0"])[0])
+        except (KeyError, ValueError) as e:
+            self.respond(400, {"error": "bad search: {}".format(e)})
+            return
+        delay, failed = self.server.network.sample()
+        time.sleep(delay)
+        if failed:
+            self.respond(503, {"error": "injected failure"})
+            return
+        results = self.server.backend.search(query, pages, first_page)
+        self.respond(200, {"results": backends.pack_results(results)})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # one line per search would drown out everything else under load
+        pass
+
+
+class StandinServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Local stand-in for the search service, serving searches recorded with
+    --record_searches over HTTP, so the search, caching and scoring paths can
+    be driven offline with realistic latency and failures. Search it with
+    --search http://<host>:<port>.
+    """
+    daemon_threads = True
+    request_queue_size = kRequestQueueSize
+
+    def __init__(self, recordings, network, host="127.0.0.1",
+                 port=kDefaultPort):
+        """
+        Args:
+            recordings (String): JSON lines file written by RecordingBackend
+            network (NetworkModel): of the latency and failures to simulate
+            host (String): to listen on
+            port (Number): to listen on, 0 for any free port
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.backend = backends.ReplayBackend(recordings)
+        self.network = network
+        super().__init__((host, port), StandinHandler)
+
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+
+def main():
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description="Serves recorded searches over HTTP with simulated \
+        latency, jitter and errors")
+    arg_parser.add_argument("--recordings", required=True,
+                            help="Searches recorded with --record_searches")
+    arg_parser.add_argument("--host", default="127.0.0.1",
+                            help="The address to listen on "
+                            "(default: 127.0.0.1)")
+    arg_parser.add_argument("--port", type=int, default=kDefaultPort,
+                            help="The port to listen on (default: 8080)")
+    arg_parser.add_argument("--latency", type=float, default=0.0,
+                            help="Mean ms before each search responds "
+                            "(default: 0)")
+    arg_parser.add_argument("--jitter", type=float, default=0.0,
+                            help="Standard deviation of the latency in ms "
+                            "(default: 0)")
+    arg_parser.add_argument("--error_rate", type=float, default=0.0,
+                            help="Fraction of searches that fail with a 503 "
+                            "(default: 0)")
+    arg_parser.add_argument("--seed", type=int,
+                            help="Seed for the latency and errors, for "
+                            "repeatable runs")
+    args = arg_parser.parse_args()
+
+    network = NetworkModel(args.latency / 1000.0, args.jitter / 1000.0,
+                           args.error_rate, args.seed)
+    server = StandinServer(args.recordings, network, args.host, args.port)
+    server.logger.info("Serving searches on {}".format(server.url()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+
+from PIL import Image
+from PIL import ImageDraw
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kPolicies = ["full", "annotated", "crops", "downscale", "none"]
+# PNG zlib level, 1 encodes several times faster than PIL's default of 6 for
+# a slightly larger file
+kDefaultPNGLevel = 1
+# frames are shrunk by this factor under the downscale policy
+kDownscaleFactor = 2
+
+
+def annotate(image, bounds):
+    """Returns a copy of an image with each (x, y, w, h) outline drawn
+    """
+    annotated = image.copy()
+    image_draw = ImageDraw.Draw(annotated)
+    for x, y, w, h in bounds:
+        image_draw.rectangle([x, y, x + w, y + h], outline="red")
+    return annotated
+
+
+class FrameWriter:
+    """Saves the frame of each question according to a storage policy:
+        full       the frame as captured, replayable with --source replay
+        annotated  the frame with every section outlined, for reviewing
+        crops      only the question and answer sections
+        downscale  the frame at 1/kDownscaleFactor size
+        none       nothing
+    """
+
+    def __init__(self, images_dir, policy="full", png_level=kDefaultPNGLevel):
+        """
+        Args:
+            images_dir (String): to save to
+            policy (String): one of kPolicies
+            png_level (Number): zlib compression level 0-9, lower is faster
+        """
+        if policy not in kPolicies:
+            raise ValueError("Unknown storage policy {}, expected one of {}".format(
+                policy, kPolicies))
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.images_dir = images_dir
+        self.policy = policy
+        self.png_level = png_level
+
+    def save(self, frame, capture_id, regions):
+        """Saves a frame
+
+        Args:
+            frame: PIL.Image of the full frame
+            capture_id (String): the id the question's results were saved with
+            regions (List): of the layout Regions OCR'd from the frame
+        Returns:
+            (List): of the files written
+        """
+        if self.policy == "none":
+            return []
+        images = []
+        if self.policy == "crops":
+            for r in regions:
+                images.append(("crop_{}_{}".format(capture_id, r.name),
+                               frame.crop((r.x, r.y, r.x + r.w, r.y + r.h))))
+        else:
+            if self.policy == "annotated":
+                frame = annotate(frame, [(r.x, r.y, r.w, r.h) for r in regions])
+            elif self.policy == "downscale":
+                frame = frame.resize((frame.width // kDownscaleFactor,
+                                      frame.height // kDownscaleFactor),
+                                     Image.BILINEAR)
+            images.append(("capture_{}".format(capture_id), frame))
+        paths = []
+        for name, image in images:
+            path = os.path.join(self.images_dir, name + ".png")
+            image.save(path, compress_level=self.png_level)
+            paths.append(path)
+        self.logger.info("Saved capture as {}".format(", ".join(paths)))
+        return paths
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import difflib
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+logging.basicConfig(format='(%(levelname)s) %(message)s', level=logging.INFO)
+kNonAlphanumeric = re.compile(r"[\W_]+")
+# similarity of a word as read and as stored to count as an OCR misread,
+# "first" and "last" are only 0.44 alike
+kMisreadRatio = 0.7
+# misread words a question may have and still be the same question
+kMaxMisreads = 2
+# most recent results with the same answers checked for a near match
+kNearMatchCandidates = 50
+
+
+def normalize_question(question):
+    """Normalizes a question so OCR spacing and punctuation noise is ignored
+    """
+    return kNonAlphanumeric.sub("", question.lower())
+
+
+def question_words(question):
+    return [w for w in kNonAlphanumeric.split(question.lower()) if w]
+
+
+def is_misread(question, candidate):
+    """Returns True if two questions differ only as OCR misreads them: a few
+    words that are spelled nearly the same or split differently. Words that
+    are added, dropped or reworded, and any change of a number, make them
+    different questions.
+    """
+    words = question_words(question)
+    candidate_words = question_words(candidate)
+    misreads = 0
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(
+            None, words, candidate_words, autojunk=False).get_opcodes():
+        if tag == "equal":
+            continue
+        read = "".join(words[i1:i2])
+        stored = "".join(candidate_words[j1:j2])
+        if read == stored:
+            # the same letters, only split into words differently
+            continue
+        if not read or not stored or \
+                any(c.isdigit() for c in read + stored):
+            return False
+        if difflib.SequenceMatcher(None, read, stored).ratio() < kMisreadRatio:
+            return False
+        misreads += 1
+    return misreads <= kMaxMisreads
+
+
+def question_hash(question):
+    return hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()
+
+
+def answers_hash(answers):
+    """Hashes the normalized answers, ignoring their order on screen
+    """
+    key = "|".join(sorted(normalize_question(a) for a in answers))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class ResultStore:
+    """Append-only SQLite store of every question's results, indexed by the
+    normalized question, the answers and the time they were saved
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "id TEXT PRIMARY KEY, ts REAL, question_hash TEXT, "
+                        "answers_hash TEXT, question TEXT, data TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_question "
+                        "ON results (question_hash, answers_hash)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_answers "
+                        "ON results (answers_hash, ts)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_ts "
+                        "ON results (ts)")
+        self.db.commit()
+
+    def append(self, data, ts=None):
+        """Saves the results of a question
+
+        Args:
+            data (Dict): with at least an id, question and answers
+            ts (Number): time the results were made, defaults to now
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (data['id'], ts or time.time(),
+                 question_hash(data['question']),
+                 answers_hash(data['answers']), data['question'],
+                 json.dumps(data)))
+            self.db.commit()
+
+    def get(self, id):
+        """Returns the results saved with an id, or None
+        """
+        with self.lock:
+            row = self.db.execute("SELECT data FROM results WHERE id = ?",
+                                  (id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def lookup(self, question, answers):
+        """Finds the latest answered results for the same question and answers.
+        The question matches if it normalizes to the same text, or failing
+        that, is a misread of a recent question with the same answers.
+
+        Returns:
+            (Dict): of the stored results, or None if never seen
+        """
+        answers_key = answers_hash(answers)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT data FROM results WHERE question_hash = ? AND "
+                "answers_hash = ? ORDER BY ts DESC LIMIT 1",
+                (question_hash(question), answers_key)).fetchone()
+            if row:
+                return json.loads(row[0])
+            candidates = self.db.execute(
+                "SELECT question, data FROM results WHERE answers_hash = ? "
+                "ORDER BY ts DESC LIMIT ?",
+                (answers_key, kNearMatchCandidates)).fetchall()
+        for candidate, data in candidates:
+            if is_misread(question, candidate):
+                return json.loads(data)
+        return None
+
+    def recent(self, limit):
+        """Returns the data of the latest saved questions, newest first
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT data FROM results ORDER BY ts DESC LIMIT ?",
+                (limit,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def import_directory(self, results_dir):
+        """Imports the per-file results_<id>.json files written by older
+        versions, using each file's modification time as its timestamp
+
+        Returns:
+            (Number): of files imported
+        """
+        imported = 0
+        for path in sorted(glob.glob(os.path.join(results_dir, "*.json"))):
+            with open(path) as fp:
+                try:
+                    data = json.load(fp)
+                except ValueError as e:
+                    self.logger.error("Skipping {}: {}".format(path, e))
+                    continue
+            if not all(k in data for k in ['id', 'question', 'answers']):
+                self.logger.error("Skipping {}: incomplete".format(path))
+                continue
+            self.append(data, os.path.getmtime(path))
+            imported += 1
+        self.logger.info("Imported {} results from {}".format(
+            imported, results_dir))
+        return imported
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def main():
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description="Imports per-file results into a result store")
+    arg_parser.add_argument("--store", "-s", default="results/results.db",
+                            help="The result store (default: results/results.db)")
+    arg_parser.add_argument("--import_dir", "-i", default="results",
+                            help="Directory of results_<id>.json files "
+                            "(default: results)")
+    args = arg_parser.parse_args()
+    store = ResultStore(args.store)
+    store.import_directory(args.import_dir)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()